@@ -0,0 +1,76 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+
+class ResultCache:
+
+	def __init__(self, directory, commandname, argdict, max_size):
+		os.makedirs(directory, exist_ok=True)
+		self.max_size = max_size
+		# results of the same command are shared by lines with the same options
+		self.namespace = pickle.dumps((commandname, sorted(argdict.items())), protocol=4)
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(os.path.join(directory, "cache.sqlite"), timeout=60, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=OFF")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB, size INTEGER, used REAL)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+		self.connection.commit()
+		self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, instream):
+		return hashlib.sha256(self.namespace + pickle.dumps(instream, protocol=4)).digest()
+
+	def get(self, instreams):
+		keys = [self.key(instream) for instream in instreams]
+		with self.lock:
+			found = {}
+			for i in range(0, len(keys), 500):
+				chunk = keys[i:i+500]
+				found.update(self.connection.execute("SELECT key, value FROM results WHERE key IN (%s)" % ",".join("?" * len(chunk)), chunk).fetchall())
+			if found:
+				self.connection.executemany("UPDATE results SET used = ? WHERE key = ?", [(time.time(), key) for key in found])
+				self.connection.commit()
+		outstreams = [pickle.loads(found[key]) if key in found else None for key in keys]
+		hits = sum(outstream is not None for outstream in outstreams)
+		with self.lock:
+			self.hits += hits
+			self.misses += len(keys) - hits
+		return outstreams
+
+	def put(self, results):
+		rows = []
+		now = time.time()
+		for instream, outstream in results:
+			value = pickle.dumps(outstream, protocol=4)
+			rows.append((self.key(instream), value, len(value), now))
+		if not rows:
+			return
+		with self.lock:
+			self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+			self.size += sum(row[2] for row in rows)
+			if self.size > self.max_size:
+				self.evict()
+			self.connection.commit()
+
+	def evict(self):
+		# other runs may share the directory, so the size is counted again
+		self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+		target = self.max_size * 0.9
+		evicted = []
+		for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY used"):
+			if self.size <= target:
+				break
+			evicted.append((key,))
+			self.size -= size
+		self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
@@ -0,0 +1,154 @@
+import queue
+import threading
+import subprocess
+
+
+def readline(stdout):
+	line = stdout.readline()
+	if not line:
+		raise EOFError()
+	return line
+
+
+class ChildProcess:
+
+	def __init__(self, args, read, showerr=False, inflight=1, timeout=None, retries=0, fallback=None):
+		self.args = args
+		self.read = read
+		self.showerr = showerr
+		self.inflight = int(inflight)
+		if self.inflight < 1:
+			raise Exception("inflight must be at least 1")
+		self.timeout = float(timeout) if timeout is not None else None
+		self.retries = int(retries)
+		self.fallback = fallback
+		self.restarts = 0
+		self.timeouts = 0
+		# positions of the outputs of the last batch which are the fallback, not results of the process
+		self.fallback_indices = set()
+		self.writer = None
+		self.start()
+
+	def start(self):
+		# standard error is discarded, since a full pipe nobody reads would stall the process
+		self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None if self.showerr else subprocess.DEVNULL, universal_newlines=True)
+		self.outputs = None
+		if self.timeout is not None:
+			self.outputs = queue.Queue()
+			threading.Thread(target=self.read_loop, args=(self.process.stdout, self.outputs), daemon=True).start()
+		self.writer = None
+		if self.inflight > 1:
+			self.requests = queue.Queue()
+			self.slots = threading.Semaphore(self.inflight)
+			self.writer = threading.Thread(target=self.write_loop, args=(self.process.stdin, self.requests, self.slots), daemon=True)
+			self.writer.start()
+
+	def read_loop(self, stdout, outputs):
+		try:
+			while True:
+				outputs.put((self.read(stdout), None))
+		except Exception as e:
+			outputs.put((None, e))
+
+	@staticmethod
+	def write_loop(stdin, requests, slots):
+		try:
+			while True:
+				data = requests.get()
+				if data is None:
+					break
+				if not slots.acquire(blocking=False):
+					# records already written have to reach the process before waiting for their results
+					stdin.flush()
+					slots.acquire()
+				stdin.write(data)
+				if requests.empty():
+					stdin.flush()
+		except (OSError, ValueError):
+			# the reader notices that the process has exited
+			return
+
+	def receive(self):
+		try:
+			if self.outputs is None:
+				return self.read(self.process.stdout)
+			output, error = self.outputs.get(timeout=self.timeout)
+			if error is not None:
+				raise error
+			return output
+		except queue.Empty:
+			self.timeouts += 1
+			raise Exception("`%s' did not answer in %g seconds" % (" ".join(self.args), self.timeout))
+		except EOFError:
+			raise Exception("`%s' has exited" % " ".join(self.args))
+
+	def transfer(self, datas, outputs):
+		if self.writer is None:
+			for data in datas:
+				self.process.stdin.write(data)
+				self.process.stdin.flush()
+				outputs.append(self.receive())
+			return
+		for data in datas:
+			self.requests.put(data)
+		for data in datas:
+			outputs.append(self.receive())
+			self.slots.release()
+
+	def process_batch(self, datas):
+		outputs = []
+		attempts = 0
+		self.fallback_indices = set()
+		while len(outputs) < len(datas):
+			done = len(outputs)
+			try:
+				self.transfer(datas[done:], outputs)
+			except Exception:
+				if len(outputs) > done:
+					attempts = 0
+				if attempts >= self.retries and self.fallback is None:
+					raise
+				# the records written after the failing one are lost with the process, and are sent again
+				self.restart()
+				if attempts < self.retries:
+					attempts += 1
+				else:
+					attempts = 0
+					self.fallback_indices.add(len(outputs))
+					outputs.append(self.fallback)
+		return outputs
+
+	def restart(self):
+		self.stop()
+		self.restarts += 1
+		self.start()
+
+	def stop(self):
+		self.process.kill()
+		self.process.wait()
+		if self.writer is not None:
+			self.requests.put(None)
+			for i in range(self.inflight):
+				self.slots.release()
+			self.writer.join()
+		for fp in (self.process.stdin, self.process.stdout):
+			try:
+				fp.close()
+			except OSError:
+				pass
+
+	def close(self):
+		if self.writer is not None:
+			self.requests.put(None)
+			self.writer.join()
+		try:
+			self.process.stdin.close()
+		except OSError:
+			pass
+		try:
+			self.process.wait(10)
+		except subprocess.TimeoutExpired:
+			self.process.kill()
+
+	def kill(self):
+		self.process.kill()
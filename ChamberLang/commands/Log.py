@@ -1,3 +1,6 @@
+from ChamberLang.sink import OutputFile
+
+
 class Command:
 
 	def InputSize(self, size):
@@ -7,15 +10,22 @@ class Command:
 	OutputSize = 0
 	MultiThreadable = False
 
-	def __init__(self, file, tags):
-		self.fp = open(file, "a", buffering=1)
+	def __init__(self, file, tags, buff=-1, flush_size=1 << 20, background=False, fsync="none", rotate_records=0, rotate_size=0):
+		self.output = None
 		self.tags = tags.split(";")
+		self.output = OutputFile(file, "a", buff, None, None, flush_size, background, fsync, rotate_records, rotate_size)
 
 	def routine(self, instream):
-		for tag, data in zip(self.tags, instream):
-			print("%s: " % tag, end="", file=self.fp)
-			print(data, file=self.fp)
+		self.output.write(("".join("%s: %s\n" % (tag, data) for tag, data in zip(self.tags, instream)),))
 		return ()
 
+	def routine_batch(self, instreams):
+		self.output.write(["".join("%s: %s\n" % (tag, data) for tag, data in zip(self.tags, instream)) for instream in instreams])
+		return [()] * len(instreams)
+
+	def close(self):
+		self.output.close()
+
 	def __del__(self):
-		self.fp.close()
+		if self.output is not None:
+			self.output.close()
@@ -0,0 +1,93 @@
+import os
+import glob
+import mmap
+import pickle
+import bisect
+from array import array
+
+
+class Command:
+
+	InputSize = 0
+	OutputSize = 1
+	MultiThreadable = True
+	ShareResources = True
+	Checkpoint = True
+
+	def __init__(self, threads, file, index=None, encoding="utf-8", checkpoint=None):
+		self.encoding = encoding
+		self.files = sorted(glob.glob(file))
+		if not self.files:
+			raise Exception("No file matches `%s'" % file)
+		stats = [(os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in self.files]
+
+		self.offsets = None
+		if index and os.path.exists(index):
+			with open(index, "rb") as fp:
+				data = pickle.load(fp)
+			if data["files"] == stats:
+				self.offsets = [array("Q", offsets) for offsets in data["offsets"]]
+		if self.offsets is None:
+			self.offsets = []
+			for f in self.files:
+				with open(f, "rb") as fp:
+					self.offsets.append(Command.build_index(fp))
+			if index:
+				with open(index, "wb") as fp:
+					pickle.dump({"files": stats, "offsets": [offsets.tobytes() for offsets in self.offsets]}, fp)
+
+		self.maps = []
+		for f, offsets in zip(self.files, self.offsets):
+			if offsets[-1] == 0:
+				# an empty file can not be mapped
+				self.maps.append(b"")
+				continue
+			with open(f, "rb") as fp:
+				self.maps.append(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+		# the first line of each file in the whole stream
+		self.starts = [0]
+		for offsets in self.offsets:
+			self.starts.append(self.starts[-1] + len(offsets) - 1)
+		self.base = checkpoint["records"] if checkpoint is not None else 0
+
+	@staticmethod
+	def build_index(fp):
+		offsets = array("Q", [0])
+		data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fp.fileno()).st_size else b""
+		pos = data.find(b"\n")
+		while pos != -1:
+			offsets.append(pos + 1)
+			pos = data.find(b"\n", pos + 1)
+		if offsets[-1] != len(data):
+			offsets.append(len(data))
+		if data:
+			data.close()
+		return offsets
+
+	def routine(self, thread_id, instream):
+		raise Exception("MappedRead has to be given the order of records")
+
+	def routine_range(self, thread_id, start, count):
+		start += self.base
+		outstreams = []
+		f = bisect.bisect_right(self.starts, start) - 1
+		while len(outstreams) < count:
+			if f >= len(self.offsets):
+				outstreams.append(None)
+				break
+			offsets = self.offsets[f]
+			line = start + len(outstreams) - self.starts[f]
+			end = min(len(offsets) - 1, line + count - len(outstreams))
+			data = self.maps[f]
+			outstreams.extend((data[offsets[i]:offsets[i + 1]].decode(self.encoding),) for i in range(line, end))
+			f += 1
+		return outstreams
+
+	def checkpoint(self):
+		# any range can be produced again, so only the resume point is needed
+		return {"records": self.base}
+
+	def __del__(self):
+		for data in getattr(self, "maps", []):
+			if data:
+				data.close()
@@ -1,17 +1,42 @@
 import threading
 
+from ChamberLang.compression import open_text
+
 class Command:
 
 	InputSize = 0
 	OutputSize = 1
 	MultiThreadable = False
+	Checkpoint = True
 
-	def __init__(self, file):
-		self.fp = open(file, "r")
+	def __init__(self, file, compression=None, checkpoint=None):
+		self.fp = open_text(file, "r", compression)
+		self.lock = threading.Lock()
+		self.records = 0
+		self.offset = 0
+		if checkpoint is not None:
+			# compressed files can not seek, and are read again from the beginning
+			if checkpoint["state"] is not None and checkpoint["state"]["offset"] is not None:
+				self.fp.seek(checkpoint["state"]["offset"])
+				self.records = checkpoint["state"]["records"]
+			while self.records < checkpoint["records"] and self.fp.readline():
+				self.records += 1
 
 	def routine(self, instream):
-		line = self.fp.readline()
-		if not line:
-			self.fp.close()
-			return None
+		with self.lock:
+			line = self.fp.readline()
+			if not line:
+				self.offset = self.fp.tell() if self.fp.seekable() else None
+				self.fp.close()
+				return None
+			self.records += 1
 		return (line,)
+
+	def checkpoint(self):
+		with self.lock:
+			if not self.fp.closed:
+				self.offset = self.fp.tell() if self.fp.seekable() else None
+			return {"records": self.records, "offset": self.offset}
+
+	def close(self):
+		self.fp.close()
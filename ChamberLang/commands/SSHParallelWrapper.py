@@ -1,18 +1,14 @@
-import socket
-
-import paramiko
-import getpass
-
 import re
-import pickle
 import threading
-import sys
+import time
 import os
 
-from ChamberLang.core import MessageException, ChamberRuntimeError
+from ChamberLang.core import MessageException
+from ChamberLang.remote import NodeConnection, ParallelWrapper, connect_all, start_node
 
 
 def GetDecriptedKey(filename, password):
+	import paramiko
 	supported_keys = [paramiko.DSSKey, paramiko.ECDSAKey, paramiko.RSAKey]
 	saved_exception = None
 	for loader in supported_keys:
@@ -25,49 +21,26 @@ def GetDecriptedKey(filename, password):
 	raise saved_exception
 
 
-class Command:
+class Command(ParallelWrapper):
 
 	KeyData = {None: None}
 
-	def InputSize(self, size):
-		if callable(self.klass.InputSize):
-			if self.local_wrapper:
-				self.local_wrapper[0].InputSize(size)
-		else:
-			if size != self.klass.InputSize:
-				raise Exception("Input size mismatch (required %d, given %d)" % (self.klass.InputSize, size))
-
-	def OutputSize(self, size):
-		if callable(self.klass.OutputSize):
-			if self.local_wrapper:
-				self.local_wrapper[0].OutputSize(size)
-		else:
-			if size != self.klass.OutputSize:
-				raise Exception("Output size mismatch (required %d, given %d)" % (self.klass.OutputSize, size))
-
-	MultiThreadable = True
-	ShareResources = True
-
 	re_host_port_threads = re.compile(r"(.+)\:(\d+)\/(\d+)$")
 	re_host_threads = re.compile(r"(.+)\/(\d+)$")
 
 
-	def __init__(self, threads, basecmd, nodes, ssh_user, node_exec=None, ssh_pass=None, keyfile=None, keypass=None, **kwargs):
+	def __init__(self, threads, basecmd, nodes, ssh_user, node_exec=None, ssh_pass=None, keyfile=None, keypass=None, node_window=64, node_frame_size=8, node_compression="none", node_timeout=60, ssh_max_sessions=10, local_threads=None, **kwargs):
 
-		try:
-			if hasattr(__import__("plugins", fromlist=[basecmd]), basecmd):
-				self.klass = getattr(__import__("plugins", fromlist=[basecmd]), basecmd).Command
-			else:
-				self.klass = getattr(__import__("ChamberLang.commands", fromlist=[basecmd]), basecmd).Command
-		except AttributeError:
-			raise Exception("Command \"%s\" is not found" % basecmd)
-		if not self.klass.MultiThreadable or self.klass.ShareResources:
-			raise Exception("Command \"%s\" is not callable by SSHParallelWrapper (required: MultiThreadable=True, ShareResources=False)" % commandname)
+		# paramiko is slow to import, so it is loaded only when the wrapper is used
+		import paramiko
+		import getpass
+
+		self.find_command(basecmd)
 
 		self.lock = threading.Lock()
-		self.ssh_wrappers = []
-		self.local_wrapper = []
+		self.ssh_clients = []
 
+		hosts = []
 		for node in nodes.split(";"):
 			m = Command.re_host_port_threads.match(node)
 			if m:
@@ -77,64 +50,115 @@ class Command:
 			else:
 				m = Command.re_host_threads.match(node)
 				if not m:
-					raise Exception("Invalid server name `%s'" % server)
+					raise Exception("Invalid server name `%s'" % node)
 				host = m.group(1)
 				port = 22
 				node_threads = int(m.group(2))
+			# a host given twice still gets a single connection
+			for i, (h, p, t) in enumerate(hosts):
+				if (h, p) == (host, port):
+					hosts[i] = (h, p, t + node_threads)
+					break
+			else:
+				hosts.append((host, port, node_threads))
 
-			for i in range(node_threads):
-				try:
-					if keyfile and keyfile not in Command.KeyData:
-						Command.KeyData[keyfile] = GetDecriptedKey(keyfile, password=keypass)
-				except (paramiko.PasswordRequiredException, paramiko.SSHException):
-					keypass = getpass.getpass("Password for `%s': " % keyfile)
-					try:
-						Command.KeyData[keyfile] = GetDecriptedKey(keyfile, password=keypass)
-					except:
-						raise MessageException("Key type or password is wrong (supported: DSA, ECDSA, and RSA)")
-
-				ssh = paramiko.SSHClient()
-				ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-				try:
-					ssh.connect(host, username=ssh_user, password=ssh_pass, pkey=Command.KeyData[keyfile])
-				except paramiko.AuthenticationException:
-					ssh_pass = getpass.getpass("Password for `%s@%s': " % (ssh_user, host))
-					ssh.connect(host, username=ssh_user, password=ssh_pass, pkey=Command.KeyData[keyfile])
-				if not node_exec:
-					node_exec = os.path.join(os.path.dirname(__file__), "../../ssh-parallel-node.py")
-				ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(node_exec)
-				ssh_stdout.FLAG_BINARY = True
-				print(basecmd, file=ssh_stdin)
-				p_cmd_args = pickle.dumps(kwargs)
-				print(len(p_cmd_args), file=ssh_stdin)
-				ssh_stdin.write(p_cmd_args)
-				ssh_stdin.flush()
-				self.ssh_wrappers.append((ssh, ssh_stdin, ssh_stdout, ssh_stderr, host))
-
-		self.local_wrapper = [self.klass(**kwargs) for i in range(threads - len(self.ssh_wrappers))]
-
-
-	def routine(self, thread_id, instream):
-		if thread_id < len(self.ssh_wrappers):
-			ssh_stdin = self.ssh_wrappers[thread_id][1]
-			ssh_stdout = self.ssh_wrappers[thread_id][2]
-			ssh_stderr = self.ssh_wrappers[thread_id][3]
-			hostname = self.ssh_wrappers[thread_id][4]
-
-			p_instream = pickle.dumps(instream)
-			print(len(p_instream), file=ssh_stdin)
-			ssh_stdin.write(p_instream)
-			ssh_stdin.flush()
-			datasize = ssh_stdout.readline()
-			p_outdata = ssh_stdout.read(int(datasize))
-			outdata = pickle.loads(p_outdata)
-			if outdata["status"] == "failed":
-				raise ChamberRuntimeError("Runtime error in `%s'" % hostname, outdata["data"])
-			outstream = outdata["data"]
-
-		else:
-			tid = thread_id - len(self.ssh_wrappers)
-			outstream = self.local_wrapper[tid].routine(instream)
-
-		return outstream
-
+		try:
+			if keyfile and keyfile not in Command.KeyData:
+				Command.KeyData[keyfile] = GetDecriptedKey(keyfile, password=keypass)
+		except (paramiko.PasswordRequiredException, paramiko.SSHException):
+			keypass = getpass.getpass("Password for `%s': " % keyfile)
+			try:
+				Command.KeyData[keyfile] = GetDecriptedKey(keyfile, password=keypass)
+			except:
+				raise MessageException("Key type or password is wrong (supported: DSA, ECDSA, and RSA)")
+
+		if not node_exec:
+			node_exec = os.path.join(os.path.dirname(__file__), "../../ssh-parallel-node.py")
+		self.ssh_user = ssh_user
+		self.ssh_pass = ssh_pass
+		self.pkey = Command.KeyData[keyfile]
+		self.prompt_lock = threading.Lock()
+		# sshd refuses channels beyond MaxSessions on one connection, which is 10 by default
+		self.max_sessions = int(ssh_max_sessions)
+		if self.max_sessions < 1:
+			raise Exception("ssh_max_sessions must be at least 1")
+
+		# hosts are connected at the same time, and the nodes of a host share its connection as channels
+		connect = lambda host, port, node_threads: self.connect_host(host, port, node_threads, node_exec, basecmd, kwargs, node_window, node_frame_size, node_compression, node_timeout)
+		results = connect_all(connect, hosts)
+		for result in results:
+			if not isinstance(result, Exception):
+				self.ssh_clients.extend(result[0])
+				self.connections.extend(result[1])
+		for result in results:
+			if isinstance(result, Exception):
+				self.close()
+				raise result
+
+		self.start_local(threads, kwargs, local_threads)
+
+
+	def connect_host(self, host, port, node_threads, node_exec, basecmd, kwargs, node_window, node_frame_size, node_compression, node_timeout):
+		started = time.perf_counter()
+		# the first connection settles the password, and the others of the host reuse it
+		clients = [self.open_client(host, port)]
+		count = (node_threads + self.max_sessions - 1) // self.max_sessions
+		results = connect_all(lambda: self.open_client(host, port), [()] * (count - 1))
+		clients.extend(c for c in results if not isinstance(c, Exception))
+		connected = time.perf_counter()
+
+		name = "%s:%d" % (host, port)
+		def start(ssh):
+			ssh_stdin, ssh_stdout, protocol = start_node(lambda: Command.exec_node(ssh, node_exec), basecmd, kwargs, node_compression)
+			return NodeConnection(ssh_stdin, ssh_stdout, name, node_window, node_frame_size, protocol, node_timeout, ssh_stdin.channel.close)
+		connections = []
+		if len(clients) == count:
+			connections = connect_all(start, [(clients[i // self.max_sessions],) for i in range(node_threads)])
+		errors = [c for c in results + connections if isinstance(c, Exception)]
+		if errors:
+			for ssh in clients:
+				ssh.close()
+			raise errors[0]
+
+		with self.lock:
+			self.startup["%s connect" % name] = connected - started
+			self.startup["%s %d nodes" % (name, node_threads)] = time.perf_counter() - connected
+		return clients, connections
+
+	def open_client(self, host, port):
+		import paramiko
+		import getpass
+
+		ssh = paramiko.SSHClient()
+		ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+		password = self.ssh_pass
+		prompted = False
+		while True:
+			try:
+				ssh.connect(host, port=port, username=self.ssh_user, password=password, pkey=self.pkey)
+				return ssh
+			except paramiko.AuthenticationException:
+				with self.prompt_lock:
+					# hosts failing at the same time try the password given for another host before asking again
+					if self.ssh_pass == password:
+						if prompted:
+							raise
+						self.ssh_pass = getpass.getpass("Password for `%s@%s': " % (self.ssh_user, host))
+						prompted = True
+					password = self.ssh_pass
+
+	@staticmethod
+	def exec_node(ssh, node_exec):
+		ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(node_exec)
+		ssh_stdout.FLAG_BINARY = True
+		return ssh_stdin, ssh_stdout
+
+	def close(self):
+		super().close()
+		for ssh in self.ssh_clients:
+			ssh.close()
+
+	def kill(self):
+		super().kill()
+		for ssh in self.ssh_clients:
+			ssh.close()
@@ -0,0 +1,106 @@
+import re
+import time
+import socket
+import threading
+
+from ChamberLang.remote import NodeConnection, ParallelWrapper, connect_all, load_secret, start_node
+
+
+class Command(ParallelWrapper):
+
+	re_unix_threads = re.compile(r"unix:(.+)\/(\d+)$")
+	re_host_port_threads = re.compile(r"(.+)\:(\d+)\/(\d+)$")
+
+
+	def __init__(self, threads, basecmd, nodes, node_window=64, node_frame_size=8, node_compression="none", node_timeout=60, connect_timeout=30, local_threads=None, node_secret_file=None, **kwargs):
+
+		self.find_command(basecmd)
+
+		self.lock = threading.Lock()
+		self.connect_timeout = float(connect_timeout)
+		# anyone who can reach a server could make it unpickle data, so both sides have to know the secret
+		secret = load_secret(node_secret_file)
+
+		slots = []
+		for node in nodes.split(";"):
+			m = Command.re_unix_threads.match(node)
+			if m:
+				address = (socket.AF_UNIX, m.group(1))
+				name = "unix:%s" % m.group(1)
+				node_threads = int(m.group(2))
+			else:
+				m = Command.re_host_port_threads.match(node)
+				if not m:
+					raise Exception("Invalid node address `%s'" % node)
+				address = (socket.AF_INET6 if ":" in m.group(1) else socket.AF_INET, (m.group(1), int(m.group(2))))
+				name = "%s:%s" % (m.group(1), m.group(2))
+				node_threads = int(m.group(3))
+			slots.extend([(address, name)] * node_threads)
+
+		def start(address, name):
+			started = time.perf_counter()
+			stdin, stdout, protocol = start_node(lambda: self.open(address), basecmd, kwargs, node_compression, secret)
+			connection = NodeConnection(stdin, stdout, name, node_window, node_frame_size, protocol, node_timeout, stdin.abort)
+			with self.lock:
+				self.startup[name] = max(self.startup.get(name, 0.0), time.perf_counter() - started)
+			return connection
+
+		# all slots of all nodes are connected at the same time
+		results = connect_all(start, slots)
+		self.connections = [c for c in results if not isinstance(c, Exception)]
+		for result in results:
+			if isinstance(result, Exception):
+				self.close()
+				raise result
+
+		self.start_local(threads, kwargs, local_threads)
+
+
+	def open(self, address):
+		family, addr = address
+		sock = socket.socket(family, socket.SOCK_STREAM)
+		sock.settimeout(self.connect_timeout)
+		try:
+			sock.connect(addr)
+		except OSError as e:
+			sock.close()
+			raise Exception("Could not connect to `%s': %s" % (addr, e))
+		# the timeout is only for connecting, since records can take any time
+		sock.settimeout(None)
+		if family != socket.AF_UNIX:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return SocketFile(sock, "wb"), sock.makefile("rb")
+
+	def kill(self):
+		super().kill()
+		# the receivers wake up, and the nodes stop their commands at the end of input
+		for connection in self.connections:
+			connection.stdin.abort()
+
+
+class SocketFile:
+
+	def __init__(self, sock, mode):
+		self.sock = sock
+		self.fp = sock.makefile(mode)
+
+	def write(self, data):
+		return self.fp.write(data)
+
+	def flush(self):
+		self.fp.flush()
+
+	def close(self):
+		self.fp.close()
+		# closing a file of a socket does not tell the node that records are over
+		try:
+			self.sock.shutdown(socket.SHUT_WR)
+		except OSError:
+			pass
+
+	def abort(self):
+		# the receiver blocked on the socket wakes up as well
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
@@ -1,7 +1,7 @@
-import subprocess
-
 import shlex
 
+from ChamberLang.child import ChildProcess, readline
+
 
 class Command:
 
@@ -10,13 +10,43 @@ class Command:
 	MultiThreadable = True
 	ShareResources = False
 
-	def __init__(self, command, showerr=False):
-		self.command = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None if showerr else subprocess.PIPE, universal_newlines=True)
+	def __init__(self, command, showerr=False, inflight=1, delimiter=None, sentinel=None, timeout=None, retries=0, fallback=None):
+		self.delimiter = delimiter if delimiter is not None else sentinel
+		self.sentinel = sentinel + "\n" if sentinel is not None else ""
+		if fallback is not None and (self.delimiter is None or fallback):
+			fallback += "\n"
+		self.child = ChildProcess(shlex.split(command), self.read, showerr, inflight, timeout, retries, fallback)
+		self.last_fallbacks = set()
+
+	def read(self, stdout):
+		if self.delimiter is None:
+			return readline(stdout)
+		lines = []
+		while True:
+			line = readline(stdout)
+			if line.rstrip("\n") == self.delimiter:
+				return "".join(lines)
+			lines.append(line)
 
 	def routine(self, instream):
-		if instream[0] == "":
-			return ("",)
-		self.command.stdin.write(instream[0])
-		self.command.stdin.flush()
-		outstream = self.command.stdout.readline()
-		return (outstream,)
+		return self.routine_batch([instream])[0]
+
+	def routine_batch(self, instreams):
+		# empty records are not given to the command
+		positions = [i for i, instream in enumerate(instreams) if instream[0] != ""]
+		datas = [instreams[i][0] + self.sentinel for i in positions]
+		outputs = iter(self.child.process_batch(datas))
+		self.last_fallbacks = {positions[i] for i in self.child.fallback_indices}
+		return [(next(outputs),) if instream[0] != "" else ("",) for instream in instreams]
+
+	def fallbacks(self):
+		return self.last_fallbacks
+
+	def supervision(self):
+		return self.child.restarts, self.child.timeouts
+
+	def close(self):
+		self.child.close()
+
+	def kill(self):
+		self.child.kill()
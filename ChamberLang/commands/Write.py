@@ -1,17 +1,47 @@
 import threading
 
+from ChamberLang.sink import OutputFile
+
 class Command:
 
 	InputSize = 1
 	OutputSize = 0
 	MultiThreadable = False
+	Checkpoint = True
 
-	def __init__(self, file, buff=-1):
-		self.fp = open(file, "w", buffering=buff)
+	def __init__(self, file, buff=-1, compression=None, level=None, flush_size=1 << 20, background=False, fsync="none", rotate_records=0, rotate_size=0, checkpoint=None):
+		self.lock = threading.Lock()
+		self.output = None
+		self.skip = 0
+		state = checkpoint["state"] if checkpoint is not None else None
+		self.output = OutputFile(file, "w", buff, compression, level, flush_size, background, fsync, rotate_records, rotate_size, state)
+		if state is not None:
+			self.skip = state["records"] - checkpoint["records"]
 
 	def routine(self, instream):
-		self.fp.write(instream[0])
+		with self.lock:
+			if self.skip:
+				self.skip -= 1
+				return ()
+			self.output.write((instream[0],))
 		return ()
 
+	def routine_batch(self, instreams):
+		with self.lock:
+			# records after the checkpoint are written again, and are dropped
+			skipped = min(self.skip, len(instreams))
+			self.skip -= skipped
+			self.output.write([instream[0] for instream in instreams[skipped:]])
+		return [()] * len(instreams)
+
+	def checkpoint(self):
+		with self.lock:
+			return self.output.checkpoint()
+
+	def close(self):
+		with self.lock:
+			self.output.close()
+
 	def __del__(self):
-		self.fp.close()
+		if self.output is not None:
+			self.output.close()
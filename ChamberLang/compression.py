@@ -0,0 +1,111 @@
+import io
+import os
+import threading
+
+
+extensions = {
+	".gz": "gzip",
+	".bz2": "bz2",
+	".xz": "xz",
+	".lzma": "xz",
+	".zst": "zstd",
+}
+
+CHUNK_SIZE = 1 << 20
+
+
+def detect(filename, compression=None):
+	if compression is None:
+		return extensions.get(os.path.splitext(filename)[1].lower())
+	if compression == "none":
+		return None
+	if compression not in extensions.values():
+		raise Exception("Unknown compression `%s' (supported: %s)" % (compression, ", ".join(sorted(set(extensions.values())))))
+	return compression
+
+
+def open_binary(filename, mode, compression, level=None):
+	# codecs are imported only when they are used
+	if compression == "gzip":
+		import gzip
+		return gzip.open(filename, mode, **({"compresslevel": int(level)} if level is not None else {}))
+	if compression == "bz2":
+		import bz2
+		return bz2.open(filename, mode, **({"compresslevel": int(level)} if level is not None else {}))
+	if compression == "xz":
+		import lzma
+		return lzma.open(filename, mode, **({"preset": int(level)} if level is not None and mode == "wb" else {}))
+	try:
+		import zstandard
+	except ImportError:
+		raise Exception("zstandard module is required for `%s'" % filename)
+	if mode == "wb":
+		return zstandard.open(filename, mode, cctx=zstandard.ZstdCompressor(level=int(level)) if level is not None else None)
+	return zstandard.open(filename, mode)
+
+
+class PipeFile(io.TextIOWrapper):
+
+	def __init__(self, fd, mode, worker, encoding=None, buffering=-1):
+		raw = io.FileIO(fd, mode)
+		size = buffering if buffering > 1 else io.DEFAULT_BUFFER_SIZE
+		buffer = io.BufferedReader(raw, size) if mode == "r" else io.BufferedWriter(raw, size)
+		super().__init__(buffer, encoding=encoding, line_buffering=buffering == 1)
+		self.worker = worker
+
+	def close(self):
+		if self.closed:
+			return
+		try:
+			super().close()
+		finally:
+			self.worker.join()
+		if self.worker.error is not None:
+			raise self.worker.error
+
+
+class Worker(threading.Thread):
+
+	def __init__(self, source, destination):
+		super().__init__(daemon=True)
+		self.source = source
+		self.destination = destination
+		self.error = None
+
+	def run(self):
+		# zlib, bz2, lzma and zstandard release the GIL, so the codec runs beside the pipeline
+		try:
+			while True:
+				chunk = self.source.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				self.destination.write(chunk)
+		except BrokenPipeError:
+			pass
+		except Exception as e:
+			self.error = e
+		finally:
+			for fp in (self.source, self.destination):
+				try:
+					fp.close()
+				except Exception as e:
+					if self.error is None and not isinstance(e, BrokenPipeError):
+						self.error = e
+
+
+def open_text(filename, mode="r", compression=None, level=None, buffering=-1):
+	compression = detect(filename, compression)
+	if compression is None:
+		return open(filename, mode, buffering=buffering)
+	if mode not in ("r", "w"):
+		raise Exception("Compressed files can not be opened with mode `%s'" % mode)
+	compressed = open_binary(filename, mode + "b", compression, level)
+	r, w = os.pipe()
+	if mode == "r":
+		worker = Worker(compressed, open(w, "wb"))
+		fd = r
+	else:
+		worker = Worker(io.FileIO(r, "r"), compressed)
+		fd = w
+	worker.start()
+	return PipeFile(fd, mode, worker, buffering=buffering)
@@ -5,8 +5,15 @@ import shlex
 import sys
 import readline
 import errno
-from collections import defaultdict
+from collections import defaultdict, deque
 import traceback
+import time
+import json
+import os
+
+from ChamberLang.registry import CommandRegistry, get_registry
+from ChamberLang.profiler import Profiler, switch_line
+from ChamberLang.cache import ResultCache
 
 
 class Killed(Exception):
@@ -34,6 +41,18 @@ class ChamberRuntimeError(Exception):
 		return repr(self.value)
 
 
+def check_size(klass, command, insize, outsize):
+	if callable(klass.InputSize):
+		command.InputSize(insize)
+	elif insize != klass.InputSize:
+		raise Exception("Input size mismatch (required %d, given %d)" % (klass.InputSize, insize))
+
+	if callable(klass.OutputSize):
+		command.OutputSize(outsize)
+	elif outsize != klass.OutputSize:
+		raise Exception("Output size mismatch (required %d, given %d)" % (klass.OutputSize, outsize))
+
+
 class DistributorVariable:
 	def __init__(self):
 		self.target = set()
@@ -51,146 +70,730 @@ class DistributorVariable:
 				return False
 		return True
 
+	def push_block(self, datas, order):
+		for proc, i in self.target:
+			if not proc.put_block(i, datas, order):
+				return False
+		return True
+
+
+class ReorderWindow:
+	def __init__(self, size):
+		self.size = size
+		self.finished = bytearray(size)
+		self.top = 0
+		self.lock = threading.Lock()
+		self.waiters = {}
+		self.released = False
+		self.blocking_hook = None
+
+	def extend(self, size):
+		# only before running, the ring buffer is empty at that time
+		if size > self.size:
+			self.finished = bytearray(size)
+			self.size = size
+
+	def wait(self, order):
+		with self.lock:
+			while order >= self.top + self.size and not self.released:
+				condition = self.waiters.get(order)
+				if condition is None:
+					condition = self.waiters[order] = threading.Condition(self.lock)
+				if self.blocking_hook is not None:
+					self.blocking_hook(True)
+					condition.wait()
+					self.blocking_hook(False)
+				else:
+					condition.wait()
+			return self.top + self.size
+
+	def mark(self, order, count):
+		with self.lock:
+			for o in range(order, order + count):
+				self.finished[o % self.size] = 1
+			top = self.top
+			while self.finished[top % self.size]:
+				self.finished[top % self.size] = 0
+				top += 1
+			if top == self.top:
+				return
+			if self.waiters:
+				# wake up only producers waiting for the slots freed now
+				for o in range(self.top + self.size, top + self.size):
+					condition = self.waiters.pop(o, None)
+					if condition is not None:
+						condition.notify_all()
+			self.top = top
+
+	def occupancy(self):
+		return sum(self.finished)
+
+	def release(self):
+		with self.lock:
+			self.released = True
+			for condition in self.waiters.values():
+				condition.notify_all()
+			self.waiters.clear()
+
+
+class FusedCommand:
+
+	InputSize = 1
+	OutputSize = 1
+	MultiThreadable = True
+	ShareResources = False
+
+	def __init__(self, commands):
+		self.commands = [(klass(**argdict), linenumber) for klass, argdict, linenumber in commands]
+
+	def routine(self, instream):
+		for command, linenumber in self.commands:
+			switch_line(linenumber)
+			try:
+				instream = command.routine(instream)
+			except Exception:
+				raise ChamberRuntimeError("Runtime error in fused line %d" % linenumber, traceback.format_exc())
+			if instream is None:
+				return None
+		return instream
+
+	def routine_batch(self, instreams):
+		stopped = False
+		for command, linenumber in self.commands:
+			switch_line(linenumber)
+			try:
+				if hasattr(command, "routine_batch"):
+					outstreams = list(command.routine_batch(instreams))
+				else:
+					outstreams = []
+					for instream in instreams:
+						outstreams.append(command.routine(instream))
+						if outstreams[-1] is None:
+							break
+			except Exception:
+				raise ChamberRuntimeError("Runtime error in fused line %d" % linenumber, traceback.format_exc())
+			if None in outstreams:
+				outstreams = outstreams[:outstreams.index(None)]
+				stopped = True
+			instreams = outstreams
+		return instreams + [None] if stopped else instreams
+
+	def hook_prompt(self, statement):
+		for command, linenumber in self.commands:
+			if hasattr(command, "hook_prompt"):
+				command.hook_prompt(statement)
+
+	def kill(self):
+		for command, linenumber in self.commands:
+			if hasattr(command, "kill"):
+				command.kill()
+
+	def close(self):
+		for command, linenumber in self.commands:
+			if hasattr(command, "close"):
+				command.close()
+
+	def supervision(self):
+		counts = [command.supervision() for command, linenumber in self.commands if hasattr(command, "supervision")]
+		return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
 
 class Processor:
-	def __init__(self, commandname, argdict, insize, outsize, threads=1, unsrt_limit=100, has_extensions=False):
-		try:
-			if has_extensions and hasattr(__import__("extensions", fromlist=[commandname]), commandname):
-				self.klass = getattr(__import__("extensions", fromlist=[commandname]), commandname).Command
-			elif hasattr(__import__("plugins", fromlist=[commandname]), commandname):
-				self.klass = getattr(__import__("plugins", fromlist=[commandname]), commandname).Command
-			else:
-				self.klass = getattr(__import__("ChamberLang.commands", fromlist=[commandname]), commandname).Command
-		except AttributeError:
-			raise Exception("Command \"%s\" is not found" % commandname)
+	def __init__(self, commandname, argdict, insize, outsize, threads=1, unsrt_limit=100, batch=1, processes=False, has_extensions=False, klass=None, initial_threads=None, resume=None, cache=None, speculate=None):
+		self.commandname = commandname
+		self.klass = klass if klass is not None else get_registry(has_extensions).find(commandname)
+		self.argdict = argdict
+		self.threads = threads
 
-		if not self.klass.MultiThreadable:
-			self.command = [self.klass(**argdict)]
-		elif self.klass.ShareResources:
-			self.command = [self.klass(threads=threads, **argdict)]
-		else:
-			self.command = [self.klass(**argdict) for i in range(threads)]
+		self.processes = processes
+		if processes and (not self.klass.MultiThreadable or self.klass.ShareResources):
+			raise MessageException("Command \"%s\" can not be run on processes (required: MultiThreadable=True, ShareResources=False)" % commandname)
+		self.command = []
+		self.resume = resume
+		# instances for the other threads are added when the line is scaled up
+		self.active_limit = threads if initial_threads is None else initial_threads
+		self.scale_condition = threading.Condition()
+		self.profiler = None
+		self.cache = cache
+		if speculate is not None and (not self.klass.MultiThreadable or insize == 0 or threads < 2):
+			raise MessageException("Command \"%s\" can not be speculated (required: MultiThreadable=True, an input and two or more threads)" % commandname)
+		self.speculate = speculate
+		self.add_instances(self.active_limit, insize, outsize)
 
-		if callable(self.klass.InputSize):
-			self.command[0].InputSize(insize)
-		elif insize != self.klass.InputSize:
-			raise Exception("Input size mismatch (required %d, given %d)" % (self.klass.InputSize, insize))
+		if not processes:
+			check_size(self.klass, self.command[0], insize, outsize)
 
-		if callable(self.klass.OutputSize):
-			self.command[0].OutputSize(outsize)
-		elif outsize != self.klass.OutputSize:
-			raise Exception("Output size mismatch (required %d, given %d)" % (self.klass.OutputSize, outsize))
+		# sources that can not seek are resumed by dropping the records already written
+		if resume is not None and insize == 0 and not getattr(self.klass, "Checkpoint", False):
+			for i in range(resume["records"]):
+				if self.command[0].routine(()) is None:
+					break
 
 		self.inputqueue = queue.Queue()
 		self.outputvariable = [DistributorVariable() for i in range(outsize)]
 		self.lock = threading.Lock()
-		self.ackput_condition = threading.Condition()
+		self.input_lock = threading.Lock()
 		self.seqorder = 0
-		self.unsrt_limit = unsrt_limit
+		self.batch = batch
+		# a whole block has to fit in the window, or its last records would never be accepted
+		self.window = ReorderWindow(max(unsrt_limit, batch))
 		self.temp_input = defaultdict(lambda : {})
-		self.unsrt_memory = [False] * (self.unsrt_limit + 1)
-		self.unsrt_top = 0
+		self.temp_block = defaultdict(lambda : {})
 		self.stop_at = -1
 		self.process_cnt = 0
 		self.singlethread_order = 0
-		self.threads = threads
 		self.InputSize = insize
 		self.OutputSize = outsize
 		self.killing = False
 		self.done = False
+		self.on_ready = None
+		self.records_in = 0
+		self.routine_time = 0.0
+		self.put_wait_time = 0.0
+		# blocks being processed, and the time per record of the latest ones to find stragglers
+		self.running_blocks = {}
+		self.latencies = deque(maxlen=1000)
+		self.speculated = 0
+		self.speculation_wins = 0
+
+	def add_instances(self, count, insize=None, outsize=None):
+		if self.command and (not self.klass.MultiThreadable or self.klass.ShareResources):
+			return
+		if self.processes:
+			from ChamberLang.process import ProcessCommand
+			insize = self.InputSize if insize is None else insize
+			outsize = self.OutputSize if outsize is None else outsize
+			commands = [ProcessCommand(self.klass, self.argdict, insize, outsize) for i in range(len(self.command), count)]
+			try:
+				for c in commands:
+					c.wait_ready()
+			except:
+				for c in commands:
+					c.kill()
+				raise
+			self.command.extend(commands)
+		elif not self.klass.MultiThreadable:
+			self.command.append(self.klass(**self.checkpoint_args(), **self.argdict))
+		elif self.klass.ShareResources:
+			self.command.append(self.klass(threads=self.threads, **self.checkpoint_args(), **self.argdict))
+		else:
+			self.command.extend(self.klass(**self.argdict) for i in range(len(self.command), count))
+
+	def checkpoint_args(self):
+		if self.resume is not None and getattr(self.klass, "Checkpoint", False):
+			return {"checkpoint": self.resume}
+		return {}
+
+	def scale(self, limit):
+		self.add_instances(limit)
+		with self.scale_condition:
+			self.active_limit = limit
+			self.scale_condition.notify_all()
+
+	def park(self, thread_id):
+		with self.scale_condition:
+			while thread_id >= self.active_limit and not self.done and not self.killing:
+				self.scale_condition.wait()
+		return not self.done and not self.killing
+
+	def wake_parked(self):
+		with self.scale_condition:
+			self.scale_condition.notify_all()
+
+	def stats(self):
+		restarts, timeouts = self.supervision()
+		return {
+			"command": self.commandname,
+			"threads": self.threads if self.klass.MultiThreadable else 1,
+			"active_threads": self.active_limit if self.klass.MultiThreadable else 1,
+			"processes": self.processes,
+			"batch": self.batch,
+			"records_in": self.records_in,
+			"records_out": self.process_cnt,
+			"routine_time": self.routine_time,
+			"put_wait_time": self.put_wait_time,
+			"queue": self.inputqueue.qsize(),
+			"window": self.window.occupancy(),
+			"window_size": self.window.size,
+			"done": self.done,
+			"cache_hits": self.cache.hits if self.cache is not None else 0,
+			"cache_misses": self.cache.misses if self.cache is not None else 0,
+			"restarts": restarts,
+			"timeouts": timeouts,
+			"speculated": self.speculated,
+			"speculation_wins": self.speculation_wins,
+		}
+
+	def supervision(self):
+		# commands on worker processes keep their counts there
+		if self.processes or not hasattr(self.klass, "supervision"):
+			return 0, 0
+		counts = [c.supervision() for c in list(self.command)]
+		return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+	def close(self):
+		if self.processes or hasattr(self.klass, "close"):
+			for c in self.command:
+				c.close()
+		if self.cache is not None:
+			self.cache.close()
+
+	def startup_time(self):
+		# commands can break down the time they took to start
+		if self.processes or not hasattr(self.klass, "startup_time"):
+			return {}
+		return self.command[0].startup_time()
+
+	def checkpoint(self):
+		if not getattr(self.klass, "Checkpoint", False):
+			return None
+		return self.command[0].checkpoint()
+
+	def kill(self):
+		if self.processes:
+			for c in self.command:
+				c.kill()
+		elif hasattr(self.klass, "kill"):
+			for c in self.command:
+				c.kill()
+
+	def extend_window(self, unsrt_limit):
+		self.window.extend(unsrt_limit)
 
 	def put_stop_request(self, order):
-		self.stop_at = order
+		with self.input_lock:
+			self.stop_at = order if self.stop_at < 0 else min(self.stop_at, order)
+			self.enqueue_blocks((order - 1) // self.batch, (order - 1) // self.batch)
 		for i in range(self.threads):
-			self.inputqueue.put((order, None))
+			self.enqueue((order, None))
 
 	def put_data(self, i, data, order):
-		with self.ackput_condition:
-			while order >= self.unsrt_top + self.unsrt_limit and not self.killing:
-				self.ackput_condition.wait()
-		if self.done:
-			return False
-		if self.killing:
-			raise Killed("killing is set")
-		self.temp_input[order][i] = data
-		if self.klass.MultiThreadable:
-			if len(self.temp_input[order]) == self.InputSize:
-				self.inputqueue.put((order, [x[1] for x in sorted(self.temp_input.pop(order).items())]))
-		else:
-			while self.singlethread_order in self.temp_input:
-				if len(self.temp_input[self.singlethread_order]) < self.InputSize:
-					break
-				self.inputqueue.put((self.singlethread_order, [x[1] for x in sorted(self.temp_input.pop(self.singlethread_order).items())]))
+		return self.put_block(i, [data], order)
+
+	def put_block(self, i, datas, order):
+		pos = 0
+		while pos < len(datas):
+			started = time.perf_counter()
+			end = min(len(datas), self.window.wait(order + pos) - order)
+			waited = time.perf_counter() - started
+			if self.done:
+				return False
+			if self.killing:
+				raise Killed("killing is set")
+			with self.input_lock:
+				self.put_wait_time += waited
+				for k in range(pos, end):
+					inputs = self.temp_input[order + k]
+					inputs[i] = datas[k]
+					if len(inputs) == self.InputSize:
+						self.records_in += 1
+						del self.temp_input[order + k]
+						self.temp_block[(order + k) // self.batch][order + k] = [inputs[x] for x in range(self.InputSize)]
+				self.enqueue_blocks((order + pos) // self.batch, (order + end - 1) // self.batch)
+			pos = end
+		return True
+
+	def enqueue_blocks(self, first, last):
+		if not self.klass.MultiThreadable:
+			# single thread commands have to receive blocks in order
+			while self.enqueue_block(self.singlethread_order):
 				self.singlethread_order += 1
+			return
+		for b in range(first, last + 1):
+			self.enqueue_block(b)
+
+	def enqueue_block(self, b):
+		# blocks are aligned to multiples of the batch size, and the last one is cut at the stop order
+		start = b * self.batch
+		size = self.batch if self.stop_at < 0 else min(self.batch, self.stop_at - start)
+		block = self.temp_block.get(b)
+		if size <= 0 or block is None or len(block) != size:
+			return False
+		del self.temp_block[b]
+		self.enqueue((start, [block[start + x] for x in range(size)]))
 		return True
 
-	def run_routine(self, thread_id_orig):
-		thread_id = thread_id_orig
-		if not self.klass.MultiThreadable or self.klass.ShareResources:
-			thread_id = 0
+	def enqueue(self, item):
+		self.inputqueue.put(item)
+		if self.on_ready is not None:
+			self.on_ready()
+
+	def stragglers(self, samples):
+		with self.lock:
+			if len(self.latencies) < samples or len(self.running_blocks) >= self.active_limit:
+				return
+			latency = sorted(self.latencies)[min(len(self.latencies) - 1, int(len(self.latencies) * self.speculate / 100))]
+			now = time.perf_counter()
+			for order, block in self.running_blocks.items():
+				if not block["copied"] and now - block["started"] > latency * len(block["instreams"]):
+					block["copied"] = True
+					self.speculated += 1
+					copy = (order, block["instreams"], True)
+					break
+			else:
+				return
+		# the copy is taken before the other blocks, since the straggler is holding the window
+		with self.inputqueue.mutex:
+			self.inputqueue.queue.appendleft(copy)
+			self.inputqueue.unfinished_tasks += 1
+			self.inputqueue.not_empty.notify()
+		if self.on_ready is not None:
+			self.on_ready()
+
+	def instance(self, thread_id):
+		if not self.klass.MultiThreadable:
+			return self.command[0], ()
+		elif self.klass.ShareResources:
+			return self.command[0], (thread_id,)
+		return self.command[thread_id], ()
+
+	def call_routine(self, thread_id, instreams, order=0):
+		command, args = self.instance(thread_id)
+		if self.InputSize == 0 and hasattr(command, "routine_range"):
+			# sources which can produce any range of records are given the order of the block
+			outstreams = list(command.routine_range(*args, order, len(instreams)))
+			if None in outstreams:
+				outstreams = outstreams[:outstreams.index(None) + 1]
+			return outstreams
+		if len(instreams) != 1 and hasattr(command, "routine_batch"):
+			outstreams = list(command.routine_batch(*args, instreams))
+			if None in outstreams:
+				outstreams = outstreams[:outstreams.index(None) + 1]
+			return outstreams
+		outstreams = []
+		for instream in instreams:
+			outstream = command.routine(*args, instream)
+			outstreams.append(outstream)
+			if outstream is None:
+				break
+		return outstreams
+
+	def call_cached(self, thread_id, instreams):
+		outstreams = self.cache.get(instreams)
+		missing = [i for i, outstream in enumerate(outstreams) if outstream is None]
+		if not missing:
+			return outstreams
+		results = self.call_routine(thread_id, [instreams[i] for i in missing])
+		# outputs a command gave up on, such as the fallback of a record that timed out, are not stored
+		command, args = self.instance(thread_id)
+		fallbacks = command.fallbacks() if not args and hasattr(command, "fallbacks") else ()
+		self.cache.put([(instreams[i], outstream) for n, (i, outstream) in enumerate(zip(missing, results)) if outstream is not None and n not in fallbacks])
+		for i, outstream in zip(missing, results):
+			outstreams[i] = outstream
+		if results and results[-1] is None:
+			# records after the end of the command are dropped even if they are cached
+			return outstreams[:missing[len(results) - 1] + 1]
+		return outstreams
+
+	def run_routine(self, thread_id, item=None):
 		if self.InputSize != 0:
-			order, instream = self.inputqueue.get()
+			if item is None:
+				item = self.inputqueue.get()
+			order, instreams = item[:2]
+			copied = len(item) > 2
 			if self.killing:
 				raise Killed("killing is set")
+			if instreams is None and self.done:
+				self.enqueue((order, None))
+				return False
+			if self.speculate is not None and instreams is not None:
+				with self.lock:
+					if not copied:
+						self.running_blocks[order] = {"started": time.perf_counter(), "instreams": instreams, "copied": False}
+					elif order not in self.running_blocks:
+						# the original finished before its copy was taken
+						return not self.done
 		else:
 			with self.lock:
+				if self.done or self.stop_at >= 0:
+					return False
 				order = self.seqorder
-				self.seqorder += 1
-			instream = ()
+				self.seqorder += self.batch
+			instreams = [()] * self.batch
+			copied = False
+		started = time.perf_counter()
+		if self.profiler is not None:
+			self.profiler.enter(self)
 		try:
-			if self.klass.MultiThreadable and self.klass.ShareResources:
-				outstream = self.command[0].routine(thread_id_orig, instream) if instream is not None else None
+			if instreams is None:
+				outstreams = None
+			elif self.cache is not None:
+				outstreams = self.call_cached(thread_id, instreams)
 			else:
-				outstream = self.command[thread_id].routine(instream) if instream is not None else None
+				outstreams = self.call_routine(thread_id, instreams, order)
 		except ChamberRuntimeError:
+			if self.killing:
+				raise Killed("killing is set")
+			if not self.finish_speculation(order, instreams, copied):
+				return not self.done
 			raise
 		except Exception as e:
+			# commands fail when their processes are killed with the run
+			if self.killing:
+				raise Killed("killing is set")
 			tr = traceback.format_exc()
+			if not self.finish_speculation(order, instreams, copied):
+				return not self.done
 			raise ChamberRuntimeError("Runtime error", tr)
-		if self.InputSize != 0:
-			with self.ackput_condition:
-				self.unsrt_memory[order - self.unsrt_top] = True
-				if False not in self.unsrt_memory:
-					unsrt_mem_shiftsize = self.unsrt_limit
-				else:
-					unsrt_mem_shiftsize = self.unsrt_memory.index(False)
-				if unsrt_mem_shiftsize != 0:
-					self.unsrt_memory[:unsrt_mem_shiftsize] = []
-					self.unsrt_memory.extend([False] * unsrt_mem_shiftsize)
-					self.unsrt_top += unsrt_mem_shiftsize
-				self.ackput_condition.notify_all()
-		if outstream is not None:
-			if len(outstream) != self.OutputSize:
-				raise ChamberRuntimeError("Returned tuple size mismatch (required %d, returned %d)" % (self.OutputSize, len(outstream)), "")
-			for i, v in enumerate(outstream):
-				if not self.outputvariable[i].push(v, order):
+		finally:
+			if self.profiler is not None:
+				self.profiler.leave()
+		elapsed = time.perf_counter() - started
+		# only the first of the two runs of a speculated block is pushed
+		if not self.finish_speculation(order, instreams, copied, elapsed / len(instreams) if instreams else None):
+			return not self.done
+		stopped = False
+		if outstreams is not None and outstreams and outstreams[-1] is None:
+			outstreams.pop()
+			stopped = True
+		if self.InputSize != 0 and instreams is not None:
+			self.window.mark(order, len(instreams))
+		if outstreams:
+			for outstream in outstreams:
+				if len(outstream) != self.OutputSize:
+					raise ChamberRuntimeError("Returned tuple size mismatch (required %d, returned %d)" % (self.OutputSize, len(outstream)), "")
+			for i in range(self.OutputSize):
+				if not self.outputvariable[i].push_block([outstream[i] for outstream in outstreams], order):
 					self.done = True
-					with self.ackput_condition:
-						self.ackput_condition.notify_all()
+					self.window.release()
+					self.wake_parked()
 					return False
 		self.lock.acquire()
-		cnt = self.process_cnt + 1 if instream is not None and outstream is not None else self.process_cnt
-		if cnt == self.stop_at or outstream is None and instream is not None:
-			if instream is not None and outstream is not None:
-				self.process_cnt += 1
+		if instreams is not None:
+			self.process_cnt += len(outstreams)
+			self.routine_time += elapsed
+		cnt = self.process_cnt
+		finished = False
+		if stopped and self.InputSize == 0:
+			# threads of a source may reach the end before the records in front of it are pushed
+			end = order + len(outstreams)
+			self.stop_at = end if self.stop_at < 0 else min(self.stop_at, end)
+			stopped = False
+			finished = True
+		if not self.done and (cnt == self.stop_at or stopped):
+			self.done = True
 			self.lock.release()
 			for ov in self.outputvariable:
 				ov.push_stop_request(cnt)
-			self.inputqueue.put((cnt, None))
-			self.done = True
-			with self.ackput_condition:
-				self.ackput_condition.notify_all()
+			self.enqueue((cnt, None))
+			self.window.release()
+			self.wake_parked()
 			return False
-		if instream is not None:
-			self.process_cnt += 1
 		self.lock.release()
+		return not self.done and not finished
+
+	def finish_speculation(self, order, instreams, copied, latency=None):
+		if self.speculate is None or instreams is None:
+			return True
+		with self.lock:
+			block = self.running_blocks.pop(order, None)
+			if block is None:
+				return False
+			if copied:
+				self.speculation_wins += 1
+			if latency is not None:
+				self.latencies.append(latency)
 		return True
 
 
+class WorkerPool:
+	def __init__(self, procs, workers, running, on_error):
+		self.procs = procs
+		self.workers = workers
+		self.running = running
+		self.on_error = on_error
+		self.condition = threading.Condition()
+		self.free_ids = {proc: list(range(proc.threads if proc.klass.MultiThreadable else 1)) for proc in procs}
+		self.active = 0
+		self.idle = 0
+		self.threads = []
+		for proc in procs:
+			proc.on_ready = self.notify
+			proc.window.blocking_hook = self.blocking
+
+	def start(self):
+		with self.condition:
+			for i in range(self.workers):
+				self.spawn()
+
+	def spawn(self):
+		t = threading.Thread(target=self.work)
+		t.start()
+		self.threads.append(t)
+
+	def join(self):
+		while any(t.is_alive() for t in self.threads):
+			for t in list(self.threads):
+				t.join()
+
+	def notify(self):
+		# checked without the lock, a wakeup missed here is covered by the timeout of idle workers
+		if self.idle:
+			with self.condition:
+				self.condition.notify()
+
+	def wake(self):
+		with self.condition:
+			self.condition.notify_all()
+
+	def blocking(self, blocked):
+		# a worker waiting for a window gives up its slot, or stages blocking each other could use up the pool
+		with self.condition:
+			if blocked:
+				self.active -= 1
+				if self.idle:
+					self.condition.notify()
+				else:
+					self.spawn()
+			else:
+				self.active += 1
+
+	def finished(self):
+		return all(proc.done or proc.killing for proc in self.procs)
+
+	def pick(self):
+		best = None
+		for proc in self.procs:
+			free_ids = self.free_ids[proc]
+			if proc.done or proc.killing or not free_ids:
+				continue
+			if proc.klass.MultiThreadable and proc.threads - len(free_ids) >= proc.active_limit:
+				continue
+			if proc.InputSize == 0:
+				# the end of the source is known, and the remaining blocks are being produced
+				if proc.stop_at >= 0:
+					continue
+				backlog = 0
+			else:
+				# the length of the underlying deque, qsize would take the lock of each queue
+				backlog = len(proc.inputqueue.queue)
+				if not backlog:
+					continue
+			if best is None or backlog > best_backlog:
+				best = proc
+				best_backlog = backlog
+		if best is None:
+			return None
+		item = best.inputqueue.get_nowait() if best.InputSize != 0 else None
+		# the lowest id is always below active_limit, so instances beyond it are not used
+		free_ids = self.free_ids[best]
+		thread_id = min(free_ids)
+		free_ids.remove(thread_id)
+		return best, thread_id, item
+
+	def work(self):
+		picked = None
+		while True:
+			with self.condition:
+				if picked is not None:
+					self.active -= 1
+					self.free_ids[proc].append(thread_id)
+					if not ret:
+						self.condition.notify_all()
+				while True:
+					if self.finished():
+						self.condition.notify_all()
+						return
+					picked = self.pick() if self.active < self.workers else None
+					if picked is not None:
+						self.active += 1
+						break
+					self.idle += 1
+					self.condition.wait(0.05)
+					self.idle -= 1
+			proc, thread_id, item = picked
+			try:
+				ret = proc.run_routine(thread_id, item)
+			except Killed:
+				ret = False
+			except ChamberRuntimeError as e:
+				self.on_error(proc, e)
+				ret = False
+			self.running.wait()
+
+
+class Autoscaler:
+	def __init__(self, procs, budget, interval, on_scale):
+		self.procs = [proc for proc in procs if proc.klass.MultiThreadable and proc.threads > 1]
+		self.budget = budget
+		self.interval = interval
+		self.on_scale = on_scale
+		self.stop = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def join(self):
+		self.stop.set()
+		self.thread.join()
+
+	def run(self):
+		last = {proc: proc.routine_time for proc in self.procs}
+		while not self.stop.wait(self.interval):
+			procs = [proc for proc in self.procs if not proc.done and not proc.killing]
+			busy = {}
+			backlog = {}
+			for proc in procs:
+				routine_time = proc.routine_time
+				busy[proc] = (routine_time - last[proc]) / (self.interval * proc.active_limit)
+				backlog[proc] = proc.inputqueue.qsize()
+				last[proc] = routine_time
+
+			# shrink idle lines first to return their threads to the budget
+			for proc in procs:
+				if proc.active_limit > 1 and not backlog[proc] and busy[proc] < 0.5:
+					self.scale(proc, proc.active_limit - 1)
+
+			used = sum(proc.active_limit for proc in procs)
+			for proc in sorted(procs, key=lambda proc: backlog[proc] * busy[proc], reverse=True):
+				if used >= self.budget:
+					break
+				if backlog[proc] <= proc.active_limit or busy[proc] < 0.8 or proc.active_limit >= proc.threads:
+					continue
+				limit = min(proc.active_limit * 2, proc.threads, proc.active_limit + self.budget - used)
+				used += limit - proc.active_limit
+				self.scale(proc, limit)
+
+	def scale(self, proc, limit):
+		try:
+			proc.scale(limit)
+		except Exception:
+			# keep running with the current threads if no more instances can be made
+			return
+		self.on_scale(proc)
+
+
+class Speculator:
+	def __init__(self, procs, interval=0.1, samples=20):
+		self.procs = [proc for proc in procs if proc.speculate is not None]
+		self.interval = interval
+		self.samples = samples
+		self.stop = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def join(self):
+		self.stop.set()
+		self.thread.join()
+
+	def run(self):
+		while not self.stop.wait(self.interval):
+			for proc in self.procs:
+				if not proc.done and not proc.killing:
+					proc.stragglers(self.samples)
+
+
 class ScriptRunner:
 	availablename_matcher = re.compile("[A-Za-z_]\w*$")
 	esc_seq_matcher = re.compile(r"\\(.)")
 	intfloat_matcher = re.compile(r"[+\-]?(\d*\.?\d+|\d+\.?\d*)$")
+	threads_matcher = re.compile(r"(\d+)([pt]?)$")
+
+	# options given with "@name=value" are for the runner, not for the command
+	line_options = {"batch", "cache", "speculate"}
 
 	def esc_replacer(m):
 		esc_ch = m.group(1)
@@ -198,12 +801,38 @@ class ScriptRunner:
 			return "\n"
 		return esc_ch
 
-	def __init__(self, lines, threads=1, unsrt_limit=100, has_extensions=False):
+	@staticmethod
+	def parse_optval(opt_tokens, linenumber):
+		if opt_tokens[0] != "=":
+			return True
+		opt_tokens.pop(0)
+		optval = opt_tokens.pop(0)
+		if optval == "True":
+			return True
+		elif optval == "False":
+			return False
+		elif len(optval) >= 2 and (optval[0] == optval[-1] == "\"" or optval[0] == optval[-1] == "'"):
+			return ScriptRunner.esc_seq_matcher.sub(ScriptRunner.esc_replacer, optval[1:-1])
+		elif ScriptRunner.intfloat_matcher.match(optval):
+			return float(optval)
+		raise ChamberInitialError("Syntax error", linenumber)
+
+	def __init__(self, lines, threads=1, unsrt_limit=100, batch=1, processes=False, fusion=True, autoscale=0, has_extensions=False, command_index=None, checkpoint_file=None, resume=None, cache_size=1024):
+		started = time.perf_counter()
+		self.registry = CommandRegistry(has_extensions, command_index)
+		# variables are resolved to definitions, since a name can be assigned again
 		variables = {}
+		producers = []
+		consumers = defaultdict(int)
+		specs = []
 		alias = {}
 		self.procs = []
 		prevline = ""
 		self.threads = threads
+		self.autoscale = autoscale
+		self.pool = None
+		self.checkpoint_file = checkpoint_file
+		self.checkpoints = resume if resume is not None else {"sinks": {}, "sources": {}}
 		self.running = threading.Event()
 		self.running.set()
 
@@ -244,9 +873,11 @@ class ScriptRunner:
 				continue
 
 			options = {}
+			lineopts = {}
 			invar_name = []
 			outvar_name = []
 			commandthreads = -1
+			commandprocesses = None
 
 			opt_tokens = tokens[1:] + [""]
 			while True:
@@ -265,68 +896,285 @@ class ScriptRunner:
 					if not ScriptRunner.availablename_matcher.match(opt_tokens[0]):
 						raise ChamberInitialError("Syntax error", n+1)
 					optname = opt_tokens.pop(0)
-					if opt_tokens[0] == "=":
-						opt_tokens.pop(0)
-						optval = opt_tokens.pop(0)
-						if optval == "True":
-							options[optname] = True
-						elif optval == "False":
-							options[optname] = False
-						elif len(optval) >= 2 and (optval[0] == optval[-1] == "\"" or optval[0] == optval[-1] == "'"):
-							string = ScriptRunner.esc_seq_matcher.sub(ScriptRunner.esc_replacer, optval[1:-1])
-							options[optname] = string
-						elif ScriptRunner.intfloat_matcher.match(optval):
-							options[optname] = float(optval)
-						else:
-							raise ChamberInitialError("Syntax error", n+1)
-					else:
-						options[optname] = True
+					options[optname] = ScriptRunner.parse_optval(opt_tokens, n+1)
+				elif token == "@":
+					if opt_tokens[0] not in ScriptRunner.line_options:
+						raise ChamberInitialError("Unknown line option \"%s\"" % opt_tokens[0], n+1)
+					optname = opt_tokens.pop(0)
+					lineopts[optname] = ScriptRunner.parse_optval(opt_tokens, n+1)
 				elif token == "*":
-					if not opt_tokens[0].isdigit() or commandthreads != -1:
+					m = ScriptRunner.threads_matcher.match(opt_tokens[0])
+					if not m or commandthreads != -1:
 						raise ChamberInitialError("Syntax error", n+1)
-					commandthreads = int(opt_tokens.pop(0))
+					opt_tokens.pop(0)
+					commandthreads = int(m.group(1))
+					if m.group(2):
+						commandprocesses = m.group(2) == "p"
 				elif token == "":
 					break
 				else:
 					raise ChamberInitialError("Syntax error", n+1)
 
 			if commandthreads == -1:
-				commandthreads = self.threads
+				# with autoscaling, lines without "*" may grow up to the whole budget
+				commandthreads = autoscale or self.threads
+			commandbatch = lineopts.get("batch", batch)
+			if commandbatch is True or commandbatch < 1 or commandbatch != int(commandbatch):
+				raise ChamberInitialError("Batch size must be a positive integer", n+1)
+			if "cache" in lineopts and not isinstance(lineopts["cache"], str):
+				raise ChamberInitialError("Cache must be a directory name", n+1)
+			if "cache" in lineopts and (not invar_name or not outvar_name):
+				raise ChamberInitialError("Cache can not be used for commands without input or output", n+1)
+			if "speculate" in lineopts and (isinstance(lineopts["speculate"], (bool, str)) or not 0 < lineopts["speculate"] < 100):
+				raise ChamberInitialError("Speculation must be given a percentile between 0 and 100", n+1)
+
+			indefs = []
+			for varname in invar_name:
+				if varname not in variables:
+					raise ChamberInitialError("Variable \"%s\" is not defined" % (varname), n+1)
+				indefs.append(variables[varname])
+				consumers[variables[varname]] += 1
+
+			outdefs = []
+			for varname in outvar_name:
+				variables[varname] = len(producers)
+				outdefs.append(len(producers))
+				producers.append(len(specs))
+
+			specs.append({
+				"line": n+1,
+				"command": command,
+				"options": options,
+				"lineopts": lineopts,
+				"indefs": indefs,
+				"outdefs": outdefs,
+				"threads": commandthreads,
+				"processes": commandprocesses,
+				"batch": int(commandbatch),
+			})
+
+		parsed = time.perf_counter()
+
+		for spec in specs:
+			try:
+				spec["klass"] = self.registry.find(spec["command"])
+			except Exception as e:
+				tr = traceback.format_exc()
+				raise ChamberInitialError(e, spec["line"], tr)
+			if spec["processes"] is None:
+				# the global setting only applies to commands that can run on processes
+				spec["processes"] = processes and spec["klass"].MultiThreadable and not spec["klass"].ShareResources
+
+		groups = []
+		group_of = {}
+		for i, spec in enumerate(specs):
+			if fusion and ScriptRunner.fusable(spec):
+				producer = producers[spec["indefs"][0]]
+				if producer in group_of and group_of[producer][-1] == producer and consumers[spec["indefs"][0]] == 1 \
+						and ScriptRunner.fusable(specs[producer]) and ScriptRunner.same_settings(specs[producer], spec):
+					group_of[producer].append(i)
+					group_of[i] = group_of[producer]
+					continue
+			group_of[i] = [i]
+			groups.append(group_of[i])
+
+		if resume is not None:
+			self.resume_records = ScriptRunner.resume_point(specs, resume)
+
+		initial_threads = 1 if autoscale else None
+		outputs = {}
+		self.init_time = {}
+		for group in groups:
+			spec = specs[group[0]]
+			last = specs[group[-1]]
+			line_started = time.perf_counter()
 			try:
-				proc = Processor(command, options, len(invar_name), len(outvar_name), threads=commandthreads, unsrt_limit=unsrt_limit, has_extensions=has_extensions)
+				if len(group) == 1:
+					cache = ResultCache(spec["lineopts"]["cache"], spec["command"], spec["options"], cache_size * 1024 * 1024) if "cache" in spec["lineopts"] else None
+					proc = Processor(spec["command"], spec["options"], len(spec["indefs"]), len(spec["outdefs"]), threads=spec["threads"], unsrt_limit=unsrt_limit,
+						batch=spec["batch"], processes=spec["processes"], klass=spec["klass"], initial_threads=initial_threads,
+						resume=self.resume_state(spec, resume) if resume is not None else None, cache=cache, speculate=spec["lineopts"].get("speculate"))
+				else:
+					chain = [specs[i] for i in group]
+					proc = Processor("+".join(c["command"] for c in chain), {"commands": [(c["klass"], c["options"], c["line"]) for c in chain]}, 1, 1,
+						threads=spec["threads"], unsrt_limit=unsrt_limit, batch=spec["batch"], processes=spec["processes"], klass=FusedCommand, initial_threads=initial_threads)
 			except MessageException as e:
-				raise ChamberInitialError(e, n+1)
+				raise ChamberInitialError(e, spec["line"])
 			except Exception as e:
 				tr = traceback.format_exc()
-				raise ChamberInitialError(e, n+1, tr)
+				raise ChamberInitialError(e, spec["line"], tr)
 
-			for i, varname in enumerate(invar_name):
-				if varname not in variables:
-					raise ChamberInitialError("Variable \"%s\" is not defined" % (varname), n+1)
-				variables[varname].add_target(proc, i)
+			for i, defid in enumerate(spec["indefs"]):
+				outputs[defid].add_target(proc, i)
 
-			for i, varname in enumerate(outvar_name):
-				variables[varname] = proc.outputvariable[i]
+			for i, defid in enumerate(last["outdefs"]):
+				outputs[defid] = proc.outputvariable[i]
 
-			self.procs.append((n+1, proc, commandthreads))
+			self.procs.append((spec["line"], proc, proc.threads))
+			self.init_time[spec["line"]] = time.perf_counter() - line_started
+
+		# a join has to accept records from one input while blocks on the other inputs are still filling
+		window = 1 + sum(proc.batch - 1 for lnum, proc, threads in self.procs)
+		for lnum, proc, threads in self.procs:
+			proc.extend_window(window)
+
+		self.startup_time = {
+			"registry": self.registry.scan_time,
+			"parse": parsed - started - self.registry.scan_time,
+			"imports": dict(self.registry.import_time),
+			"lines": self.init_time,
+			"details": dict((lnum, proc.startup_time()) for lnum, proc, threads in self.procs),
+			"total": time.perf_counter() - started,
+		}
+
+	def print_startup_time(self, fp=sys.stderr):
+		st = self.startup_time
+		print("Startup time: %.3fs" % st["total"], file=fp)
+		print("  command registry: %.3fs" % st["registry"], file=fp)
+		print("  parse: %.3fs" % st["parse"], file=fp)
+		for name, t in sorted(st["imports"].items(), key=lambda x: -x[1]):
+			print("  import %s: %.3fs" % (name, t), file=fp)
+		for lnum, proc, threads in self.procs:
+			print("  line %d (%s): %.3fs" % (lnum, proc.commandname, st["lines"][lnum]), file=fp)
+			for name, t in st["details"].get(lnum, {}).items():
+				print("    %s: %.3fs" % (name, t), file=fp)
+
+	@staticmethod
+	def load_checkpoint(filename):
+		try:
+			with open(filename, "r") as fp:
+				data = json.load(fp)
+			return {"sinks": data["sinks"], "sources": data["sources"]}
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			raise MessageException("Could not load the checkpoint `%s' (%s)" % (filename, e))
+
+	@staticmethod
+	def resume_point(specs, checkpoints):
+		# every sink has written at least this number of records
+		records = []
+		for spec in specs:
+			if spec["indefs"] and getattr(spec["klass"], "Checkpoint", False):
+				state = checkpoints["sinks"].get(str(spec["line"]))
+				records.append(state["records"] if state is not None and state["command"] == spec["command"] else 0)
+		return min(records) if records else 0
+
+	def resume_state(self, spec, checkpoints):
+		if not getattr(spec["klass"], "Checkpoint", False):
+			return {"records": self.resume_records, "state": None} if not spec["indefs"] else None
+		line = str(spec["line"])
+		state = None
+		if not spec["indefs"]:
+			source = checkpoints["sources"].get(line)
+			if source is not None and source["command"] == spec["command"]:
+				snapshots = [s for s in source["snapshots"] if s["records"] <= self.resume_records]
+				state = max(snapshots, key=lambda s: s["records"]) if snapshots else None
+		else:
+			sink = checkpoints["sinks"].get(line)
+			if sink is not None and sink["command"] == spec["command"]:
+				state = sink
+		return {"records": self.resume_records, "state": state}
+
+	def save_checkpoint(self):
+		sinks = {}
+		sources = {}
+		# sinks go first, so that sources have passed every record they have written
+		for lnum, proc, threads in self.procs:
+			if proc.InputSize != 0:
+				state = proc.checkpoint()
+				if state is not None:
+					sinks[str(lnum)] = dict(command=proc.commandname, **state)
+		resume_records = min((state["records"] for state in sinks.values()), default=0)
+		for lnum, proc, threads in self.procs:
+			if proc.InputSize == 0:
+				state = proc.checkpoint()
+				if state is None:
+					continue
+				snapshots = [s for s in self.checkpoints["sources"].get(str(lnum), {}).get("snapshots", []) if s["records"] < state["records"]] + [state]
+				# only the latest snapshot before the resume point is needed
+				older = [s for s in snapshots if s["records"] <= resume_records]
+				snapshots = older[-1:] + [s for s in snapshots if s["records"] > resume_records]
+				sources[str(lnum)] = {"command": proc.commandname, "snapshots": snapshots}
+		self.checkpoints = {"sinks": sinks, "sources": sources}
+		temp = self.checkpoint_file + ".tmp"
+		with open(temp, "w") as fp:
+			json.dump(dict(time=time.time(), records=resume_records, **self.checkpoints), fp)
+		os.replace(temp, self.checkpoint_file)
+
+	@staticmethod
+	def fusable(spec):
+		klass = spec["klass"]
+		# cached results are stored for each command, and only the speculated command is run twice
+		if "cache" in spec["lineopts"] or "speculate" in spec["lineopts"]:
+			return False
+		return klass.InputSize == 1 and klass.OutputSize == 1 and klass.MultiThreadable and not klass.ShareResources
+
+	@staticmethod
+	def same_settings(producer, spec):
+		# a different "*N" or "@batch" is kept, since it often limits the memory of a heavy command
+		return producer["processes"] == spec["processes"] and producer["threads"] == spec["threads"] and producer["batch"] == spec["batch"]
 
 	def killprocs(self):
 		for lnum, proc, threads in self.procs:
 			proc.killing = True
-			if hasattr(proc.klass, "kill"):
-				for c in proc.command:
-					c.kill()
+			proc.kill()
 			for i in range(proc.threads):
 				proc.inputqueue.put((0, None))
-			with proc.ackput_condition:
-				proc.ackput_condition.notify_all()
+			proc.window.release()
+			proc.wake_parked()
+		if self.pool is not None:
+			self.pool.wake()
 
-	def run(self, prompt=False):
+	def stats(self):
+		return [dict(line=lnum, **proc.stats()) for lnum, proc, threads in self.procs]
+
+	def print_stats(self):
+		print("%5s %-20s %8s %10s %10s %10s %10s %6s %13s" % ("Line", "Command", "Threads", "In", "Out", "Routine", "Blocked", "Queue", "Window"))
+		for st in self.stats():
+			print("%5d %-20s %7d%s %10d %10d %9.2fs %9.2fs %6d %6d/%-6d" % (
+				st["line"], st["command"][:20], st["active_threads"], "p" if st["processes"] else " ", st["records_in"], st["records_out"],
+				st["routine_time"], st["put_wait_time"], st["queue"], st["window"], st["window_size"]))
+
+	def write_stats(self, fp, started):
+		now = time.time()
+		print(json.dumps({"time": now, "elapsed": now - started, "lines": self.stats()}), file=fp)
+		fp.flush()
+
+	def run(self, prompt=False, stats_file=None, stats_interval=10.0, workers=0, autoscale_interval=1.0, profile_dir=None, checkpoint_interval=60.0):
 		prompt_lock = threading.Lock()
+		started = time.time()
+		stats_stop = threading.Event()
+
+		def checkpointWriter():
+			while not stats_stop.wait(checkpoint_interval):
+				self.save_checkpoint()
+
+		if self.checkpoint_file:
+			checkpoint_thread = threading.Thread(target=checkpointWriter, daemon=True)
+			checkpoint_thread.start()
+
+		if profile_dir:
+			profiler = Profiler(profile_dir)
+			for lnum, proc, threads in self.procs:
+				lines = None
+				if proc.klass is FusedCommand:
+					lines = [(line, name) for (klass, options, line), name in zip(proc.argdict["commands"], proc.commandname.split("+"))]
+				profiler.add(lnum, proc, lines)
+			profiler.start()
+
+		def statsWriter(fp):
+			while not stats_stop.wait(stats_interval):
+				self.write_stats(fp, started)
+
+		if stats_file:
+			stats_fp = open(stats_file, "a")
+			stats_thread = threading.Thread(target=statsWriter, args=(stats_fp,), daemon=True)
+			stats_thread.start()
 
 		def subWorker(proc, thread_id, lnum):
 			try:
 				while not proc.killing:
+					if thread_id >= proc.active_limit and not proc.park(thread_id):
+						return
 					ret = proc.run_routine(thread_id)
 					if not ret:
 						return
@@ -340,14 +1188,43 @@ class ScriptRunner:
 					print(e.value, file=sys.stderr)
 					print(e.trace, file=sys.stderr)
 
+		def reportError(proc, e):
+			self.killprocs()
+			lnum = [lnum for lnum, p, threads in self.procs if p is proc][0]
+			with prompt_lock:
+				print("At line %d:" % lnum, file=sys.stderr)
+				print(e.value, file=sys.stderr)
+				print(e.trace, file=sys.stderr)
+
 		ts = []
-		for lnum, proc, threads in self.procs:
-			if threads == -1:
-				threads = self.threads
-			for i in range(threads if proc.klass.MultiThreadable else 1):
-				t = threading.Thread(target=subWorker, args=(proc, i, lnum))
-				t.start()
-				ts.append(t)
+		started_threads = {}
+		scale_lock = threading.Lock()
+
+		def startWorkers(proc):
+			# threads are started up to the highest limit so far, and park while they are above the current one
+			with scale_lock:
+				lnum = [lnum for lnum, p, threads in self.procs if p is proc][0]
+				for i in range(started_threads.get(proc, 0), proc.active_limit if proc.klass.MultiThreadable else 1):
+					t = threading.Thread(target=subWorker, args=(proc, i, lnum))
+					t.start()
+					ts.append(t)
+					started_threads[proc] = i + 1
+
+		if workers:
+			self.pool = WorkerPool([proc for lnum, proc, threads in self.procs], workers, self.running, reportError)
+			self.pool.start()
+			ts = self.pool.threads
+		else:
+			for lnum, proc, threads in self.procs:
+				startWorkers(proc)
+
+		if self.autoscale:
+			autoscaler = Autoscaler([proc for lnum, proc, threads in self.procs], self.autoscale, autoscale_interval, lambda proc: self.pool.wake() if workers else startWorkers(proc))
+			autoscaler.start()
+
+		speculator = Speculator([proc for lnum, proc, threads in self.procs])
+		if speculator.procs:
+			speculator.start()
 
 		try:
 			if prompt:
@@ -385,17 +1262,16 @@ class ScriptRunner:
 						print("Pausing processes...")
 
 					elif statement[0] == "exit":
-						working = False
-						for t in ts:
-							if t.is_alive():
-								print("Some processes are working")
-								working = True
-								break
-						if working:
+						if any(t.is_alive() for t in ts):
+							print("Some processes are working")
 							continue
 						else:
 							break
 
+					elif statement[0] == "stats":
+						with prompt_lock:
+							self.print_stats()
+
 					elif statement[0] == "kill":
 						print("Killing processes...")
 						self.running.set()
@@ -403,10 +1279,12 @@ class ScriptRunner:
 						break
 
 					for lnum, proc, threads in self.procs:
-						if hasattr(proc.klass, "hook_prompt"):
-							for cmd in proc.command:
+						for cmd in proc.command:
+							if hasattr(cmd, "hook_prompt"):
 								cmd.hook_prompt(statement)
 
+			if self.pool is not None:
+				self.pool.join()
 			for t in ts:
 				t.join()
 
@@ -414,3 +1292,36 @@ class ScriptRunner:
 			print("Killing processes...")
 			self.running.set()
 			self.killprocs()
+
+		if self.autoscale:
+			autoscaler.join()
+		if speculator.procs:
+			speculator.join()
+
+		stats_stop.set()
+		if self.checkpoint_file:
+			checkpoint_thread.join()
+			self.save_checkpoint()
+
+		for lnum, proc, threads in self.procs:
+			try:
+				proc.close()
+			except Exception as e:
+				with prompt_lock:
+					print("At line %d:" % lnum, file=sys.stderr)
+					print(e, file=sys.stderr)
+
+		for lnum, proc, threads in self.procs:
+			restarts, timeouts = proc.supervision()
+			if restarts or timeouts:
+				print("At line %d: %d restarts, %d timeouts" % (lnum, restarts, timeouts), file=sys.stderr)
+			if proc.speculated:
+				print("At line %d: %d blocks run again, %d finished first" % (lnum, proc.speculated, proc.speculation_wins), file=sys.stderr)
+
+		if stats_file:
+			stats_thread.join()
+			self.write_stats(stats_fp, started)
+			stats_fp.close()
+
+		if profile_dir:
+			profiler.close()
@@ -0,0 +1,91 @@
+import multiprocessing
+import traceback
+
+from ChamberLang.core import MessageException, ChamberRuntimeError, check_size
+
+
+def serve(connection, modulename, classname, argdict, insize, outsize):
+	try:
+		klass = getattr(__import__(modulename, fromlist=[classname]), classname)
+		command = klass(**argdict)
+		check_size(klass, command, insize, outsize)
+	except Exception as e:
+		connection.send((False, (str(e), traceback.format_exc())))
+		return
+	connection.send((True, None))
+
+	while True:
+		try:
+			instreams = connection.recv()
+		except EOFError:
+			break
+		if instreams is None:
+			break
+		try:
+			if hasattr(command, "routine_batch"):
+				outstreams = command.routine_batch(instreams)
+			else:
+				outstreams = []
+				for instream in instreams:
+					outstream = command.routine(instream)
+					outstreams.append(outstream)
+					if outstream is None:
+						break
+			# fallbacks are told to the runner, which does not cache them
+			connection.send((True, (outstreams, command.fallbacks() if hasattr(command, "fallbacks") else set())))
+		except Exception:
+			connection.send((False, traceback.format_exc()))
+			break
+	if hasattr(command, "close"):
+		command.close()
+	del command
+
+
+class ProcessCommand:
+
+	# spawn does not inherit the locks held by other threads of the runner
+	context = multiprocessing.get_context("spawn")
+
+	def __init__(self, klass, argdict, insize, outsize):
+		self.connection, child_connection = ProcessCommand.context.Pipe()
+		self.process = ProcessCommand.context.Process(target=serve, args=(child_connection, klass.__module__, klass.__name__, argdict, insize, outsize), daemon=True)
+		self.process.start()
+		child_connection.close()
+		self.last_fallbacks = set()
+
+	def wait_ready(self):
+		try:
+			status, data = self.connection.recv()
+		except EOFError:
+			raise MessageException("Worker process exited while starting")
+		if not status:
+			raise MessageException("%s (in worker process)\n%s" % data)
+
+	def routine(self, instream):
+		return self.routine_batch([instream])[0]
+
+	def routine_batch(self, instreams):
+		self.connection.send(instreams)
+		try:
+			status, data = self.connection.recv()
+		except EOFError:
+			raise ChamberRuntimeError("Worker process exited unexpectedly", "")
+		if not status:
+			raise ChamberRuntimeError("Runtime error in worker process", data)
+		outstreams, self.last_fallbacks = data
+		return outstreams
+
+	def fallbacks(self):
+		return self.last_fallbacks
+
+	def close(self):
+		if not self.process.is_alive():
+			return
+		try:
+			self.connection.send(None)
+		except (BrokenPipeError, OSError):
+			pass
+		self.process.join()
+
+	def kill(self):
+		self.process.terminate()
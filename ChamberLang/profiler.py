@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import marshal
+import threading
+from collections import defaultdict
+
+
+# the profiler of the command running on each thread
+local = threading.local()
+
+
+def switch_line(linenumber):
+	# commands of a fused chain are reported under their own lines
+	profiler = getattr(local, "profiler", None)
+	if profiler is not None:
+		ident = threading.get_ident()
+		profiler.current[ident] = (linenumber, profiler.current[ident][1])
+
+
+class Profiler:
+
+	def __init__(self, directory, interval=0.005):
+		self.directory = directory
+		self.interval = interval
+		self.labels = {}
+		# thread ident -> (line number, frame of run_routine)
+		self.current = {}
+		# line number -> stack -> [number of samples, seconds]
+		self.samples = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+		self.stop = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def add(self, linenumber, proc, lines=None):
+		for line, name in lines or [(linenumber, proc.commandname)]:
+			self.labels[line] = "line %d (%s)" % (line, name)
+		proc.profiler = self
+		proc.profile_line = linenumber
+
+	def start(self):
+		self.thread.start()
+
+	def enter(self, proc):
+		self.current[threading.get_ident()] = (proc.profile_line, sys._getframe(1))
+		local.profiler = self
+
+	def leave(self):
+		local.profiler = None
+		self.current.pop(threading.get_ident(), None)
+
+	def run(self):
+		last = time.perf_counter()
+		while not self.stop.wait(self.interval):
+			now = time.perf_counter()
+			elapsed = now - last
+			last = now
+			frames = sys._current_frames()
+			for ident, (linenumber, root) in list(self.current.items()):
+				frame = frames.get(ident)
+				stack = []
+				while frame is not None and frame is not root:
+					code = frame.f_code
+					# frames of the engine and the profiler themselves are left out
+					if code.co_filename != root.f_code.co_filename and code.co_filename != __file__:
+						stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+					frame = frame.f_back
+				if frame is None or not stack:
+					continue
+				stack.reverse()
+				sample = self.samples[linenumber][tuple(stack)]
+				sample[0] += 1
+				sample[1] += elapsed
+			del frames
+
+	def close(self):
+		self.stop.set()
+		self.thread.join()
+		os.makedirs(self.directory, exist_ok=True)
+		merged = {}
+		for linenumber, samples in sorted(self.samples.items()):
+			label = self.labels[linenumber]
+			self.write(samples, "line-%d" % linenumber)
+			for stack, sample in samples.items():
+				merged[(("", 0, label),) + stack] = sample
+		self.write(merged, "merged")
+
+	def write(self, samples, name):
+		with open(os.path.join(self.directory, name + ".collapsed"), "w") as fp:
+			for stack, (count, elapsed) in sorted(samples.items()):
+				frames = ";".join(funcname if not filename else "%s (%s:%d)" % (funcname, filename, lineno) for filename, lineno, funcname in stack)
+				# flamegraph.pl takes integer counts, so the time is written in microseconds
+				print("%s %d" % (frames, max(1, round(elapsed * 1e6))), file=fp)
+		with open(os.path.join(self.directory, name + ".pstats"), "wb") as fp:
+			marshal.dump(Profiler.pstats(samples), fp)
+
+	@staticmethod
+	def pstats(samples):
+		# the same layout as cProfile: func -> (primitive calls, calls, total time, cumulative time, callers)
+		stats = {}
+		for stack, (count, elapsed) in samples.items():
+			seen = set()
+			for i, func in enumerate(stack):
+				cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+				leaf = i == len(stack) - 1
+				if leaf:
+					tt += elapsed
+				if func not in seen:
+					nc += count
+					ct += elapsed
+					seen.add(func)
+				if i > 0:
+					caller = stack[i - 1]
+					c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+					callers[caller] = (c_cc + count, c_nc + count, c_tt + (elapsed if leaf else 0.0), c_ct + elapsed)
+				stats[func] = (nc, nc, tt, ct, callers)
+		return stats
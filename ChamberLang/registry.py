@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import importlib.util
+
+
+class CommandRegistry:
+
+	def __init__(self, has_extensions=False, index_file=None):
+		# earlier packages take priority, in the same order as the original lookup
+		self.packages = (["extensions"] if has_extensions else []) + ["plugins", "ChamberLang.commands"]
+		self.index_file = index_file
+		self.modules = {}
+		self.klasses = {}
+		self.import_time = {}
+		started = time.perf_counter()
+		self.scan()
+		self.scan_time = time.perf_counter() - started
+
+	def package_dirs(self):
+		dirs = []
+		for package in self.packages:
+			try:
+				spec = importlib.util.find_spec(package)
+			except ImportError:
+				spec = None
+			if spec is None or not spec.submodule_search_locations:
+				continue
+			for path in spec.submodule_search_locations:
+				dirs.append((package, os.path.abspath(path)))
+		return dirs
+
+	def scan(self):
+		dirs = self.package_dirs()
+		mtimes = {path: os.stat(path).st_mtime for package, path in dirs}
+		if self.index_file and os.path.exists(self.index_file):
+			try:
+				with open(self.index_file, "r") as fp:
+					index = json.load(fp)
+				if index["mtimes"] == mtimes and index["packages"] == self.packages:
+					self.modules = index["modules"]
+					return
+			except (ValueError, KeyError, OSError):
+				pass
+
+		for package, path in dirs:
+			for filename in os.listdir(path):
+				name, ext = os.path.splitext(filename)
+				if name.startswith("_") or name in self.modules:
+					continue
+				if ext == ".py" or not ext and os.path.exists(os.path.join(path, filename, "__init__.py")):
+					self.modules[name] = "%s.%s" % (package, name)
+
+		if self.index_file:
+			with open(self.index_file, "w") as fp:
+				json.dump({"packages": self.packages, "mtimes": mtimes, "modules": self.modules}, fp)
+
+	def find(self, commandname):
+		if commandname in self.klasses:
+			return self.klasses[commandname]
+		if commandname not in self.modules:
+			raise Exception("Command \"%s\" is not found" % commandname)
+		started = time.perf_counter()
+		try:
+			klass = __import__(self.modules[commandname], fromlist=["Command"]).Command
+		except AttributeError:
+			raise Exception("Command \"%s\" is not found" % commandname)
+		self.import_time[commandname] = time.perf_counter() - started
+		self.klasses[commandname] = klass
+		return klass
+
+
+registries = {}
+
+
+def get_registry(has_extensions=False):
+	if has_extensions not in registries:
+		registries[has_extensions] = CommandRegistry(has_extensions)
+	return registries[has_extensions]
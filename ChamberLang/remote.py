@@ -0,0 +1,584 @@
+import os
+import sys
+import time
+import zlib
+import hmac
+import struct
+import pickle
+import threading
+from collections import deque
+
+from ChamberLang.core import ChamberRuntimeError, Killed
+from ChamberLang.registry import get_registry
+
+
+MAGIC = b"@chamber-node-protocol"
+
+CHALLENGE = b"@chamber-node-challenge"
+
+# environment variable holding the shared secret of node servers, when no file is given
+SECRET_VARIABLE = "CHAMBER_NODE_SECRET"
+
+# pickle is implemented in C, and joining strings in Python to avoid it was slower
+SERIALIZERS = ("pickle",)
+
+COMPRESSIONS = ("zstd", "zlib", "none")
+
+# frames smaller than this are not worth compressing
+COMPRESS_SIZE = 512
+
+# nodes tell that they are alive at this interval while they work
+HEARTBEAT_INTERVAL = 5.0
+
+
+class NodeLost(Exception):
+	pass
+
+
+class AuthenticationError(Exception):
+	pass
+
+
+def send_message(fp, obj):
+	data = pickle.dumps(obj, protocol=4)
+	fp.write(b"%d\n" % len(data) + data)
+	fp.flush()
+
+
+def receive_message(fp):
+	datasize = fp.readline()
+	if not datasize:
+		raise EOFError()
+	return pickle.loads(fp.read(int(datasize)))
+
+
+def available_compressions():
+	try:
+		import zstandard
+	except ImportError:
+		return [c for c in COMPRESSIONS if c != "zstd"]
+	return list(COMPRESSIONS)
+
+
+class LegacyProtocol:
+
+	# spoken by nodes and wrappers without the handshake: one pickled record per message, answered by a dict
+
+	name = "legacy"
+	heartbeat = False
+	pipelined = False
+
+	def __init__(self):
+		# messages carry no tags, and are answered in order
+		self.tags = deque()
+		self.tag = 0
+
+	def send_request(self, fp, tag, instreams):
+		if len(instreams) != 1:
+			raise ValueError("the old protocol takes one record at a time")
+		self.tags.append(tag)
+		send_message(fp, instreams[0])
+
+	def receive_request(self, fp):
+		instream = receive_message(fp)
+		self.tag += 1
+		return self.tag, [instream]
+
+	def send_result(self, fp, tag, status, data):
+		if status:
+			send_message(fp, {"status": "success", "data": data[0]})
+		else:
+			send_message(fp, {"status": "failed", "data": data})
+
+	def receive_result(self, fp):
+		outdata = receive_message(fp)
+		tag = self.tags.popleft()
+		if outdata["status"] == "failed":
+			return tag, False, outdata["data"]
+		return tag, True, [outdata["data"]]
+
+
+class BinaryProtocol:
+
+	header = struct.Struct("!IIBB")
+
+	PICKLE = 2
+	COMPRESSED = 0x10
+
+	HEARTBEAT = 2
+
+	heartbeat = True
+	pipelined = True
+
+	def __init__(self, serializer="pickle", compression="none"):
+		self.serializer = serializer
+		self.compression = compression
+		self.name = "%s/%s" % (serializer, compression)
+		if compression == "zstd":
+			import zstandard
+			self.compressor = zstandard.ZstdCompressor(level=1)
+			self.decompressor = zstandard.ZstdDecompressor()
+		# zstandard contexts are not thread safe
+		self.compress_lock = threading.Lock()
+
+	@staticmethod
+	def encode(items):
+		return BinaryProtocol.PICKLE, pickle.dumps(items, protocol=4)
+
+	@staticmethod
+	def decode(flags, payload):
+		return pickle.loads(payload)
+
+	def compress(self, data):
+		with self.compress_lock:
+			if self.compression == "zstd":
+				return self.compressor.compress(data)
+			return zlib.compress(data, 1)
+
+	def decompress(self, data):
+		with self.compress_lock:
+			if self.compression == "zstd":
+				return self.decompressor.decompress(data)
+			return zlib.decompress(data)
+
+	def send(self, fp, tag, status, items):
+		flags, payload = self.encode(items)
+		if self.compression != "none" and len(payload) >= COMPRESS_SIZE:
+			payload = self.compress(payload)
+			flags |= BinaryProtocol.COMPRESSED
+		fp.write(BinaryProtocol.header.pack(tag, len(payload), status, flags) + payload)
+		fp.flush()
+
+	def receive(self, fp):
+		header = fp.read(BinaryProtocol.header.size)
+		if len(header) < BinaryProtocol.header.size:
+			raise EOFError()
+		tag, size, status, flags = BinaryProtocol.header.unpack(header)
+		if status == BinaryProtocol.HEARTBEAT:
+			return tag, status, None
+		payload = fp.read(size)
+		if len(payload) < size:
+			raise EOFError()
+		if flags & BinaryProtocol.COMPRESSED:
+			payload = self.decompress(payload)
+		return tag, status, self.decode(flags, payload)
+
+	def send_request(self, fp, tag, instreams):
+		self.send(fp, tag, 0, instreams)
+
+	def receive_request(self, fp):
+		tag, status, instreams = self.receive(fp)
+		return tag, instreams
+
+	def send_result(self, fp, tag, status, data):
+		self.send(fp, tag, 0 if status else 1, data)
+
+	def receive_result(self, fp):
+		tag, status, data = self.receive(fp)
+		if status == BinaryProtocol.HEARTBEAT:
+			return None
+		return tag, status == 0, data
+
+	def send_heartbeat(self, fp):
+		fp.write(BinaryProtocol.header.pack(0, 0, BinaryProtocol.HEARTBEAT, 0))
+		fp.flush()
+
+
+def load_secret(filename=None):
+	if filename:
+		with open(filename, "rb") as fp:
+			secret = fp.read().strip()
+	else:
+		secret = os.environ.get(SECRET_VARIABLE, "").encode("utf-8")
+	if not secret:
+		raise Exception("A shared secret is required: give a file or set %s" % SECRET_VARIABLE)
+	return secret
+
+
+def sign(secret, role, nonce):
+	# the role keeps an answer of one side from being replayed as the other
+	return hmac.new(secret, role + b" " + nonce, "sha256").hexdigest().encode()
+
+
+def authenticate_client(stdin, stdout, secret):
+	# nothing is unpickled from a node until it has proved that it knows the secret, and the other way round
+	challenge = stdout.readline(256).split()
+	if len(challenge) != 2 or challenge[0] != CHALLENGE:
+		raise AuthenticationError("the node did not ask for the shared secret")
+	nonce = os.urandom(16).hex().encode()
+	stdin.write(b"%s %s\n" % (sign(secret, b"client", challenge[1]), nonce))
+	stdin.flush()
+	answer = stdout.readline(256).strip()
+	if not hmac.compare_digest(answer, sign(secret, b"server", nonce)):
+		raise AuthenticationError("the node does not know the shared secret")
+
+
+def authenticate_server(stdin, stdout, secret):
+	nonce = os.urandom(16).hex().encode()
+	stdout.write(b"%s %s\n" % (CHALLENGE, nonce))
+	stdout.flush()
+	answer = stdin.readline(256).split()
+	if len(answer) != 2 or not hmac.compare_digest(answer[0], sign(secret, b"client", nonce)):
+		raise AuthenticationError("the client does not know the shared secret")
+	stdout.write(sign(secret, b"server", answer[1]) + b"\n")
+	stdout.flush()
+
+
+def start_node(start, commandname, kwargs, compression="none", secret=None):
+	# start() runs a node and returns its stdin and stdout
+	if compression not in COMPRESSIONS:
+		raise Exception("Unknown compression `%s' (supported: %s)" % (compression, ", ".join(COMPRESSIONS)))
+	if compression not in available_compressions():
+		raise Exception("zstandard module is required for `%s'" % compression)
+	compressions = [compression, "none"] if compression != "none" else ["none"]
+	p_kwargs = pickle.dumps(kwargs)
+	header = b"%s\n%d\n" % (commandname.encode("utf-8"), len(p_kwargs)) + p_kwargs
+
+	stdin, stdout = start()
+	if secret is not None:
+		authenticate_client(stdin, stdout, secret)
+	offer = b"%s %s %s\n" % (MAGIC, ",".join(SERIALIZERS).encode(), ",".join(compressions).encode())
+	try:
+		stdin.write(offer + header)
+		stdin.flush()
+		answer = stdout.readline().split()
+	except OSError:
+		answer = []
+	if len(answer) == 3 and answer[0] == MAGIC:
+		return stdin, stdout, BinaryProtocol(answer[1].decode(), answer[2].decode())
+	if secret is not None:
+		raise Exception("The node closed the connection during the handshake")
+
+	# nodes without the handshake exit on the unknown command name, and are started again
+	stdin, stdout = start()
+	stdin.write(header)
+	stdin.flush()
+	return stdin, stdout, LegacyProtocol()
+
+
+def accept_node(stdin, stdout, secret=None):
+	if secret is not None:
+		authenticate_server(stdin, stdout, secret)
+	line = stdin.readline()
+	if not line.startswith(MAGIC + b" "):
+		return line.decode("utf-8").rstrip("\n"), LegacyProtocol()
+	magic, serializers, compressions = line.split()
+	serializer = next(s for s in serializers.decode().split(",") if s in SERIALIZERS)
+	compression = next(c for c in compressions.decode().split(",") if c in available_compressions())
+	stdout.write(b"%s %s %s\n" % (MAGIC, serializer.encode(), compression.encode()))
+	stdout.flush()
+	return stdin.readline().decode("utf-8").rstrip("\n"), BinaryProtocol(serializer, compression)
+
+
+class NodeConnection:
+
+	def __init__(self, stdin, stdout, name, window=64, frame_size=8, protocol=None, timeout=None, abort=None):
+		self.stdin = stdin
+		self.stdout = stdout
+		self.name = name
+		self.protocol = protocol if protocol is not None else LegacyProtocol()
+		# nodes of the old protocol take one record at a time
+		self.frame_size = max(1, int(frame_size)) if self.protocol.pipelined else 1
+		# nodes without heartbeats can not be told from nodes working on a long record
+		self.timeout = max(float(timeout), 2 * HEARTBEAT_INTERVAL) if timeout and self.protocol.heartbeat else None
+		self.abort = abort
+		# the window is counted in frames, and at least one frame is always in flight
+		frames = max(1, int(window) // self.frame_size) if self.protocol.pipelined else 1
+		self.slots = threading.Semaphore(frames)
+		# records the dispatcher may send before the earlier ones are answered
+		self.capacity = frames * self.frame_size
+		self.send_lock = threading.Lock()
+		self.condition = threading.Condition()
+		self.results = {}
+		self.sent = {}
+		self.last_seen = time.monotonic()
+		self.tag = 0
+		self.error = None
+		self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+		self.receiver.start()
+
+	def receive_loop(self):
+		try:
+			while True:
+				result = self.protocol.receive_result(self.stdout)
+				self.last_seen = time.monotonic()
+				if result is None:
+					continue
+				tag, status, data = result
+				with self.condition:
+					self.results[tag] = (status, data)
+					self.condition.notify_all()
+				self.slots.release()
+		except Exception as e:
+			self.fail(e)
+
+	def fail(self, error):
+		with self.condition:
+			if self.error is not None:
+				return
+			self.error = error
+			self.condition.notify_all()
+		# senders waiting for the window find the error instead of waiting forever
+		self.slots.release(1 << 16)
+		if self.abort is not None:
+			try:
+				self.abort()
+			except Exception:
+				pass
+
+	def lost(self):
+		return NodeLost("Connection to `%s' is lost: %s" % (self.name, str(self.error) or type(self.error).__name__))
+
+	def wait(self, tag):
+		with self.condition:
+			while tag not in self.results:
+				if self.error is not None:
+					raise self.lost()
+				if self.timeout is None:
+					self.condition.wait()
+					continue
+				remaining = max(self.last_seen, self.sent[tag]) + self.timeout - time.monotonic()
+				if remaining <= 0:
+					break
+				self.condition.wait(remaining)
+			else:
+				del self.sent[tag]
+				return self.results.pop(tag)
+		self.fail(TimeoutError("no answer in %g seconds" % self.timeout))
+		raise self.lost()
+
+	def process_batch(self, instreams):
+		tags = []
+		for i in range(0, len(instreams), self.frame_size):
+			# frames are sent while the node is still working on the earlier ones
+			self.slots.acquire()
+			if self.error is not None:
+				raise self.lost()
+			with self.send_lock:
+				tag = self.tag
+				self.tag = (self.tag + 1) & 0xffffffff
+				self.sent[tag] = time.monotonic()
+				try:
+					self.protocol.send_request(self.stdin, tag, instreams[i:i + self.frame_size])
+				except OSError as e:
+					self.fail(e)
+					raise self.lost()
+			tags.append(tag)
+		outstreams = []
+		for tag in tags:
+			status, data = self.wait(tag)
+			if not status:
+				raise ChamberRuntimeError("Runtime error in `%s'" % self.name, data)
+			outstreams.extend(data)
+		if None in outstreams:
+			outstreams = outstreams[:outstreams.index(None) + 1]
+		return outstreams
+
+	def close(self):
+		try:
+			self.stdin.close()
+		except OSError:
+			pass
+		self.receiver.join(10)
+
+
+class LocalWorker:
+
+	def __init__(self, command):
+		self.command = command
+		self.name = "local"
+		self.capacity = 1
+
+	def process_batch(self, instreams):
+		if hasattr(self.command, "routine_batch"):
+			return list(self.command.routine_batch(instreams))
+		outstreams = []
+		for instream in instreams:
+			outstreams.append(self.command.routine(instream))
+			if outstreams[-1] is None:
+				break
+		return outstreams
+
+	def close(self):
+		if hasattr(self.command, "close"):
+			self.command.close()
+
+	def kill(self):
+		if hasattr(self.command, "kill"):
+			self.command.kill()
+
+
+class Dispatcher:
+
+	# weight of the latest block in the service time of a worker
+	SMOOTHING = 0.3
+
+	def __init__(self, workers):
+		self.workers = workers
+		# records sent to each worker and not answered yet
+		self.inflight = [0] * len(workers)
+		self.rate = [None] * len(workers)
+		self.records = [0] * len(workers)
+		self.lost = [None] * len(workers)
+		self.killing = False
+		self.condition = threading.Condition()
+
+	def acquire(self, count):
+		with self.condition:
+			while True:
+				best = None
+				if self.killing:
+					raise Killed("killing is set")
+				if all(self.lost):
+					raise ChamberRuntimeError("All nodes are lost", "\n".join(str(e) for e in self.lost))
+				for i in range(len(self.workers)):
+					if self.lost[i] is not None:
+						continue
+					if self.rate[i] is None:
+						# workers not measured yet are tried first, with one block until their time is known
+						if self.inflight[i]:
+							continue
+						finish = 0.0
+					else:
+						# records already sent are answered first
+						finish = self.rate[i] * (self.inflight[i] + count)
+					if best is None or finish < best[0]:
+						best = (finish, i)
+				# a connection takes more blocks while its window has room, and a local command one at a time
+				if best is not None and self.inflight[best[1]] < self.workers[best[1]].capacity:
+					i = best[1]
+					ahead = self.inflight[i]
+					self.inflight[i] += count
+					return i, ahead
+				# a faster worker is expected to have room before a slower one with room would finish
+				self.condition.wait()
+
+	def release(self, i, count, ahead, elapsed):
+		with self.condition:
+			self.inflight[i] -= count
+			if elapsed is not None and count:
+				# the records sent before the block were answered in the same time
+				rate = elapsed / (count + ahead)
+				self.rate[i] = rate if self.rate[i] is None else (1 - Dispatcher.SMOOTHING) * self.rate[i] + Dispatcher.SMOOTHING * rate
+				self.records[i] += count
+			self.condition.notify_all()
+
+	def lose(self, i, error):
+		with self.condition:
+			self.lost[i] = error
+			left = sum(lost is None for lost in self.lost)
+			self.condition.notify_all()
+		print("%s; its records are sent to the other %d workers" % (error, left), file=sys.stderr)
+
+	def process_batch(self, instreams):
+		while True:
+			i, ahead = self.acquire(len(instreams))
+			started = time.perf_counter()
+			try:
+				outstreams = self.workers[i].process_batch(instreams)
+			except NodeLost as e:
+				self.release(i, len(instreams), ahead, None)
+				# connections aborted by kill() are not lost
+				if self.killing:
+					raise Killed("killing is set")
+				# the whole block is done again by another worker
+				self.lose(i, e)
+				continue
+			except:
+				self.release(i, len(instreams), ahead, None)
+				raise
+			self.release(i, len(instreams), ahead, time.perf_counter() - started)
+			return outstreams
+
+	def kill(self):
+		with self.condition:
+			self.killing = True
+			self.condition.notify_all()
+
+	def stats(self):
+		with self.condition:
+			return [(self.workers[i].name, self.records[i], self.rate[i], self.lost[i] is not None) for i in range(len(self.workers))]
+
+
+def connect_all(connect, targets):
+	# connect(*target) runs for all targets at the same time, and the first error is raised after all of them finish
+	results = [None] * len(targets)
+	def run(i):
+		try:
+			results[i] = connect(*targets[i])
+		except Exception as e:
+			results[i] = e
+	threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(len(targets))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return results
+
+
+class ParallelWrapper:
+
+	MultiThreadable = True
+	ShareResources = True
+
+	def InputSize(self, size):
+		if callable(self.klass.InputSize):
+			if self.local_wrapper:
+				self.local_wrapper[0].InputSize(size)
+		else:
+			if size != self.klass.InputSize:
+				raise Exception("Input size mismatch (required %d, given %d)" % (self.klass.InputSize, size))
+
+	def OutputSize(self, size):
+		if callable(self.klass.OutputSize):
+			if self.local_wrapper:
+				self.local_wrapper[0].OutputSize(size)
+		else:
+			if size != self.klass.OutputSize:
+				raise Exception("Output size mismatch (required %d, given %d)" % (self.klass.OutputSize, size))
+
+	def find_command(self, basecmd):
+		self.klass = get_registry().find(basecmd)
+		if not self.klass.MultiThreadable or self.klass.ShareResources:
+			raise Exception("Command \"%s\" is not callable by %s (required: MultiThreadable=True, ShareResources=False)" % (basecmd, type(self).__module__.rsplit(".", 1)[-1]))
+		self.connections = []
+		self.local_wrapper = []
+		self.dispatcher = None
+		self.startup = {}
+
+	def start_local(self, threads, kwargs, local_threads=None):
+		# threads beyond the local commands keep more blocks in the windows of the nodes
+		count = threads - len(self.connections) if local_threads is None else int(local_threads)
+		self.local_wrapper = [self.klass(**kwargs) for i in range(max(count, 0))]
+		# records go to whichever node or local command is expected to finish them first
+		self.dispatcher = Dispatcher(self.connections + [LocalWorker(c) for c in self.local_wrapper])
+
+	def startup_time(self):
+		return dict(self.startup)
+
+	def routine(self, thread_id, instream):
+		return self.routine_batch(thread_id, [instream])[0]
+
+	def routine_batch(self, thread_id, instreams):
+		return self.dispatcher.process_batch(instreams)
+
+	def hook_prompt(self, statement):
+		if statement[0] != "stats":
+			return
+		for name, records, rate, lost in self.dispatcher.stats():
+			print("  %-30s %10d records %10s%s" % (name, records, "%.2fms" % (rate * 1000) if rate is not None else "-", " (lost)" if lost else ""))
+
+	def close(self):
+		for connection in self.connections:
+			connection.close()
+		for command in self.local_wrapper:
+			if hasattr(command, "close"):
+				command.close()
+
+	def kill(self):
+		# set first, so that the connections closed by the subclasses are not taken as lost nodes
+		if self.dispatcher:
+			self.dispatcher.kill()
+		for command in self.local_wrapper:
+			if hasattr(command, "kill"):
+				command.kill()
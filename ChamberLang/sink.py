@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+
+from ChamberLang.compression import open_text, detect
+
+
+class OutputFile:
+
+	fsync_policies = ("none", "flush", "close")
+
+	def __init__(self, file, mode="w", buffering=-1, compression=None, level=None, flush_size=1 << 20, background=False, fsync="none", rotate_records=0, rotate_size=0, state=None):
+		if fsync not in OutputFile.fsync_policies:
+			raise Exception("Unknown fsync policy `%s' (supported: %s)" % (fsync, ", ".join(OutputFile.fsync_policies)))
+		self.rotated = bool(rotate_records or rotate_size)
+		if self.rotated:
+			try:
+				file % 0
+			except TypeError:
+				raise Exception("`%s' has to contain a number format such as %%05d to rotate files" % file)
+		self.file = file
+		self.mode = mode
+		self.buffering = int(buffering)
+		self.compression = compression
+		self.level = level
+		self.flush_size = int(flush_size)
+		self.fsync = fsync
+		self.rotate_records = int(rotate_records)
+		self.rotate_size = int(rotate_size)
+		self.pending = []
+		self.pending_size = 0
+		self.records = 0
+		self.index = 0
+		self.file_records = 0
+		self.file_size = 0
+		self.error = None
+		self.queue = None
+
+		if state is None:
+			self.fp = self.open(self.mode)
+		else:
+			filename = self.filename(state["index"])
+			if detect(filename, compression) is not None:
+				raise Exception("Compressed output `%s' can not be resumed" % filename)
+			if not os.path.exists(filename) or os.path.getsize(filename) < state["size"]:
+				raise Exception("`%s' is shorter than the checkpoint" % filename)
+			self.index = state["index"]
+			self.records = state["records"]
+			self.file_records = state["file_records"]
+			self.file_size = state["size"]
+			self.fp = self.open("a")
+			# records after the checkpoint are written again
+			self.fp.truncate(state["size"])
+			self.fp.seek(0, os.SEEK_END)
+
+		if background:
+			# the sink only hands chunks to the writer, and waits only when it is far behind
+			self.queue = queue.Queue(maxsize=8)
+			self.writer = threading.Thread(target=self.run, daemon=True)
+			self.writer.start()
+
+	def filename(self, index):
+		return self.file % index if self.rotated else self.file
+
+	def open(self, mode):
+		return open_text(self.filename(self.index), mode, self.compression, self.level, buffering=self.buffering)
+
+	def run(self):
+		while True:
+			fp, data = self.queue.get()
+			try:
+				if self.error is None:
+					self.output(fp, data)
+			except Exception as e:
+				# the queue is still drained, so the sink never waits for a dead writer
+				self.error = e
+			finally:
+				self.queue.task_done()
+			if fp is None:
+				break
+
+	def output(self, fp, data):
+		if fp is None:
+			return
+		if data is None:
+			if self.fsync != "none":
+				self.sync(fp)
+			fp.close()
+			return
+		fp.write(data)
+		if self.fsync == "flush":
+			self.sync(fp)
+
+	@staticmethod
+	def sync(fp):
+		fp.flush()
+		# pipes to compression threads can not be synchronized
+		if fp.seekable():
+			os.fsync(fp.fileno())
+
+	def submit(self, fp, data):
+		if self.error is not None:
+			raise self.error
+		if self.queue is not None:
+			self.queue.put((fp, data))
+		else:
+			self.output(fp, data)
+
+	def write(self, texts):
+		for text in texts:
+			self.pending.append(text)
+			self.pending_size += len(text)
+			self.records += 1
+			self.file_records += 1
+			self.file_size += len(text)
+			if self.rotated and (self.rotate_records and self.file_records >= self.rotate_records or self.rotate_size and self.file_size >= self.rotate_size):
+				self.rotate()
+		if self.pending_size >= self.flush_size:
+			self.flush()
+
+	def flush(self):
+		if self.pending:
+			data = "".join(self.pending)
+			self.pending = []
+			self.pending_size = 0
+			self.submit(self.fp, data)
+
+	def rotate(self):
+		self.flush()
+		self.submit(self.fp, None)
+		self.index += 1
+		self.file_records = 0
+		self.file_size = 0
+		self.fp = self.open(self.mode)
+
+	def wait(self):
+		self.flush()
+		if self.queue is not None:
+			self.queue.join()
+		if self.error is not None:
+			raise self.error
+
+	def checkpoint(self):
+		self.wait()
+		self.fp.flush()
+		return {"records": self.records, "index": self.index, "file_records": self.file_records, "size": self.fp.tell() if self.fp.seekable() else None}
+
+	def close(self):
+		if self.fp is None:
+			return
+		try:
+			self.flush()
+			self.submit(self.fp, None)
+			if self.queue is not None:
+				self.submit(None, None)
+				self.writer.join()
+			if self.error is not None:
+				raise self.error
+		finally:
+			self.fp = None
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import statistics
+
+from argparse import ArgumentParser
+
+
+TEXT = "  This Is A Benchmark Sentence For  The Chamber Engine .  \\n"
+
+SCENARIOS = {
+	"linear":
+		"Echo:text=\"%(text)s\":count=%(records)d > a\n"
+		"StripSpace < a > b\n"
+		"LowerCaser < b > c\n"
+		"Suffix:string=\"\" < c > d\n"
+		"Write:file=\"/dev/null\" < d\n",
+	"fanout":
+		"Echo:text=\"%(text)s\":count=%(records)d > a\n"
+		"StripSpace < a > b\n"
+		"LowerCaser < a > c\n"
+		"Suffix:string=\"\" < a > d\n"
+		"Write:file=\"/dev/null\" < b\n"
+		"Write:file=\"/dev/null\" < c\n"
+		"Write:file=\"/dev/null\" < d\n",
+	"join":
+		"Echo:text=\"%(text)s\":count=%(records)d > a\n"
+		"Echo:text=\"%(text)s\":count=%(records)d > b\n"
+		"LowerCaser < a > c\n"
+		"StripSpace < b > d\n"
+		"LengthCleaner < c d > e f\n"
+		"Write:file=\"/dev/null\" < e\n"
+		"Write:file=\"/dev/null\" < f\n",
+	"fanin":
+		"Seq:stop=%(records)d > a\n"
+		"Random:count=%(records)d > b\n"
+		"Echo:text=\"%(text)s\":count=%(records)d > c\n"
+		"LengthCleaner < c c > d e\n"
+		"Log:file=\"/dev/null\":tags=\"seq;random;text;cleaned\" < a b d e\n",
+}
+
+
+def split_list(value, cast):
+	return [cast(v) for v in value.split(",") if v]
+
+
+def current_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode("utf-8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run_once(script, threads, unsrt_limit, extra_args):
+	runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mt-chamber.py")
+	command = [sys.executable, runner, "-t", str(threads)]
+	if unsrt_limit is not None:
+		command += ["-u", str(unsrt_limit)]
+	command += extra_args + [script]
+	# errors go to a file, since a full pipe nobody reads before wait4 would stall the run
+	with tempfile.TemporaryFile() as errfp:
+		started = time.perf_counter()
+		process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=errfp)
+		# wait4 gives the resource usage of this child only
+		pid, status, usage = os.wait4(process.pid, 0)
+		elapsed = time.perf_counter() - started
+		errfp.seek(0)
+		errors = errfp.read().decode("utf-8", "replace")
+	if status != 0 or errors:
+		raise Exception("Benchmark run failed: %s\n%s" % (" ".join(command), errors))
+	return elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def measure(scenario, records, threads, unsrt_limit, extra_args, repeat):
+	results = {}
+	for count in (0, records):
+		fd, script = tempfile.mkstemp(prefix="chamber-bench-", suffix=".chamber")
+		with os.fdopen(fd, "w") as fp:
+			fp.write(SCENARIOS[scenario] % {"records": count, "text": TEXT})
+		try:
+			results[count] = [run_once(script, threads, unsrt_limit, extra_args) for i in range(repeat)]
+		finally:
+			os.remove(script)
+
+	startup = statistics.median(r[0] for r in results[0])
+	startup_cpu = statistics.median(r[1] for r in results[0])
+	elapsed = statistics.median(r[0] for r in results[records])
+	cpu = statistics.median(r[1] for r in results[records])
+	running = max(elapsed - startup, 1e-9)
+	return {
+		"scenario": scenario,
+		"threads": threads,
+		"unsrt_limit": unsrt_limit,
+		"args": " ".join(extra_args),
+		"records": records,
+		"elapsed": round(elapsed, 4),
+		"startup": round(startup, 4),
+		"records_per_sec": round(records / running, 1),
+		"cpu_us_per_record": round(max(cpu - startup_cpu, 0.0) * 1e6 / records, 2),
+		"peak_rss_kb": max(r[2] for r in results[records]),
+	}
+
+
+def result_key(result):
+	return (result["scenario"], result["threads"], result["unsrt_limit"], result["args"], result["records"])
+
+
+def main():
+	parser = ArgumentParser(description="Measure the throughput of the pipeline engine with synthetic scripts")
+	parser.add_argument("-n", "--records", type=int, default=100000, help="number of records generated by each source (default: 100000)")
+	parser.add_argument("-t", "--threads", default="1,2,4", help="comma separated list of --threads (default: 1,2,4)")
+	parser.add_argument("-u", "--unsrt-limits", dest="unsrt_limits", default="", help="comma separated list of --unsrt-limit (default: threads * 100)")
+	parser.add_argument("-s", "--scenarios", default=",".join(sorted(SCENARIOS)), help="comma separated list of scenarios (default: all of %s)" % ", ".join(sorted(SCENARIOS)))
+	parser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs of each setting, the median is reported (default: 3)")
+	parser.add_argument("-a", "--args", default="", help="extra arguments passed to mt-chamber.py, e.g. \"-b 64\"")
+	parser.add_argument("-o", "--output", default=None, help="append results to a file as JSON lines")
+	parser.add_argument("-c", "--compare", default=None, help="show the ratio of records/sec to results in a file written by --output")
+	args = parser.parse_args()
+
+	if args.records < 1:
+		parser.error("--records must be larger than 0")
+	if args.repeat < 1:
+		parser.error("--repeat must be larger than 0")
+	threads_list = split_list(args.threads, int)
+	unsrt_limits = split_list(args.unsrt_limits, int) or [None]
+	scenarios = split_list(args.scenarios, str)
+	for scenario in scenarios:
+		if scenario not in SCENARIOS:
+			parser.error("unknown scenario `%s'" % scenario)
+
+	baseline = {}
+	if args.compare:
+		with open(args.compare, "r") as fp:
+			for line in fp:
+				result = json.loads(line)
+				baseline[result_key(result)] = result
+
+	commit = current_commit()
+	output = open(args.output, "a") if args.output else None
+	columns = ["scenario", "threads", "unsrt_limit", "records_per_sec", "cpu_us_per_record", "startup", "peak_rss_kb"]
+	print("\t".join(columns + (["ratio"] if args.compare else [])))
+	try:
+		for scenario in scenarios:
+			for threads in threads_list:
+				for unsrt_limit in unsrt_limits:
+					result = measure(scenario, args.records, threads, unsrt_limit, args.args.split(), args.repeat)
+					result["commit"] = commit
+					row = [str(result[c]) for c in columns]
+					if args.compare:
+						base = baseline.get(result_key(result))
+						row.append("%.3f" % (result["records_per_sec"] / base["records_per_sec"]) if base else "-")
+					print("\t".join(row))
+					sys.stdout.flush()
+					if output:
+						print(json.dumps(result, sort_keys=True), file=output)
+						output.flush()
+	finally:
+		if output:
+			output.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -1,15 +1,36 @@
 #!/usr/bin/python3
 
 import sys
+import signal
 
-from ChamberLang.core import ScriptRunner, ChamberInitialError
+from ChamberLang.core import ScriptRunner, ChamberInitialError, MessageException
 from argparse import ArgumentParser
 
+def terminate(signum, frame):
+	# the same signal sent again to the process group does not break the shutdown
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	raise KeyboardInterrupt()
+
+
 def main():
 	parser = ArgumentParser()
 	parser.add_argument("-t", "--threads", type=int, default=1, help="number of threads (default: 1)")
 	parser.add_argument("-u", "--unsrt-limit", type=int, default=-1, help="acceptance distance of inner incorrect order (default: threads * 100)")
+	parser.add_argument("-w", "--workers", type=int, default=0, help="run all lines on a shared pool of this number of threads (default: 0, threads for each line)")
+	parser.add_argument("-a", "--autoscale", type=int, default=0, help="start each line with one thread and scale the threads within this total number (default: 0, disabled)")
+	parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=1, help="number of records passed between commands at once (default: 1)")
+	parser.add_argument("--processes", action="store_true", help="run commands that do not share resources on worker processes instead of threads")
+	parser.add_argument("--no-fusion", dest="fusion", action="store_false", help="do not fuse chains of single input and output commands into one line")
 	parser.add_argument("-p", "--prompt", action="store_true", help="run with prompt")
+	parser.add_argument("--stats-file", dest="stats_file", default=None, help="append runtime statistics of each line to a file as JSON lines")
+	parser.add_argument("--stats-interval", dest="stats_interval", type=float, default=10.0, help="interval in seconds of --stats-file (default: 10)")
+	parser.add_argument("--cache-size", dest="cache_size", type=float, default=1024, help="maximum size in MB of each directory given by @cache (default: 1024)")
+	parser.add_argument("--checkpoint", dest="checkpoint_file", default=None, help="save how far each Read and Write got to a file periodically")
+	parser.add_argument("--checkpoint-interval", dest="checkpoint_interval", type=float, default=60.0, help="interval in seconds of --checkpoint (default: 60)")
+	parser.add_argument("--resume", action="store_true", help="resume from the file given by --checkpoint")
+	parser.add_argument("--profile", dest="profile_dir", default=None, help="sample the stacks of each line and write pstats and collapsed stacks to a directory at exit")
+	parser.add_argument("--command-index", dest="command_index", default=None, help="cache the list of available commands in a file")
+	parser.add_argument("--startup-report", dest="startup_report", action="store_true", help="show the breakdown of startup time")
 	parser.add_argument("-e", "--extensions-parent-path", dest="extensions_parent_path", default=None, help="parent folder path of extended plugins")
 	parser.add_argument("FILE", nargs="?", default=None, help="Chamber script file (default: stdin)")
 	args = parser.parse_args()
@@ -17,6 +38,27 @@ def main():
 	if args.threads < 1:
 		parser.error("--threads must be larger than 1")
 
+	if args.autoscale < 0:
+		parser.error("--autoscale must not be negative")
+
+	if args.workers < 0:
+		parser.error("--workers must not be negative")
+
+	if args.stats_interval <= 0:
+		parser.error("--stats-interval must be larger than 0")
+
+	if args.cache_size <= 0:
+		parser.error("--cache-size must be larger than 0")
+
+	if args.checkpoint_interval <= 0:
+		parser.error("--checkpoint-interval must be larger than 0")
+
+	if args.resume and not args.checkpoint_file:
+		parser.error("--resume requires --checkpoint")
+
+	if args.batch_size < 1:
+		parser.error("--batch-size must be larger than 0")
+
 	if args.unsrt_limit < 0:
 		unsrt_limit = args.threads * 100
 	else:
@@ -42,14 +84,26 @@ def main():
 			print("Error: could not open `%s'" % args.FILE, file=sys.stderr)
 			return
 
+	resume = None
+	if args.resume:
+		try:
+			resume = ScriptRunner.load_checkpoint(args.checkpoint_file)
+		except MessageException as e:
+			print("Error: %s" % e, file=sys.stderr)
+			return
+
 	try:
-		script = ScriptRunner(fstream, threads=args.threads, unsrt_limit=unsrt_limit, has_extensions=has_extensions)
+		script = ScriptRunner(fstream, threads=args.threads, unsrt_limit=unsrt_limit, batch=args.batch_size, processes=args.processes, fusion=args.fusion, autoscale=args.autoscale, has_extensions=has_extensions, command_index=args.command_index, checkpoint_file=args.checkpoint_file, resume=resume, cache_size=args.cache_size)
 	except ChamberInitialError as e:
 		print("At line %d: %s" % (e.linenumber, str(e.value)), file=sys.stderr)
 		if e.trace:
 			print(e.trace, file=sys.stderr)
 		return
-	script.run(prompt=args.prompt)
+	if args.startup_report:
+		script.print_startup_time()
+	# kill stops the run like Ctrl-C, so profiles and the last checkpoint are still written
+	signal.signal(signal.SIGTERM, terminate)
+	script.run(prompt=args.prompt, stats_file=args.stats_file, stats_interval=args.stats_interval, workers=args.workers, profile_dir=args.profile_dir, checkpoint_interval=args.checkpoint_interval)
 
 	if fstream:
 		fstream.close()
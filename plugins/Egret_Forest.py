@@ -1,6 +1,4 @@
-import subprocess
-
-import shlex
+from ChamberLang.child import ChildProcess, readline
 
 
 class Command:
@@ -10,30 +8,45 @@ class Command:
     MultiThreadable = True
     ShareResources = False
 
-    def __init__(self, bin, grammer, showerr=False):
-        self.egret = subprocess.Popen([bin, "-lapcfg", "-i=/dev/stdin", "-data=%s" % grammer, "-n=500", "-printForest"],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None if showerr else subprocess.PIPE, universal_newlines=True)
-
-    def routine(self, instream):
-        token = instream[0]
+    def __init__(self, bin, grammer, showerr=False, inflight=1, timeout=None, retries=0, fallback=None):
+        self.egret = ChildProcess([bin, "-lapcfg", "-i=/dev/stdin", "-data=%s" % grammer, "-n=500", "-printForest"],
+            self.read, showerr, inflight, timeout, retries, "failed\n" + fallback if fallback is not None else None)
+        self.last_fallbacks = set()
 
-        if not token.strip():
-            return ("failed\nempty\n",)
-
-        self.egret.stdin.write(token)
-        self.egret.stdin.flush()
-        egret_tree = ""
+    def read(self, stdout):
+        egret_tree = []
         while True:
-            egret_tree_line = self.egret.stdout.readline()
+            egret_tree_line = readline(stdout)
             if not egret_tree_line.strip():
-                egret_tree += "\n"
                 break
-            egret_tree += egret_tree_line
+            egret_tree.append(egret_tree_line)
+
+        # a failed parse is followed by one more line
+        if len(egret_tree) <= 2:
+            readline(stdout)
+            return "failed\nparser"
+
+        return "success\n" + "".join(egret_tree).lower() + "\n"
+
+    def routine(self, instream):
+        return self.routine_batch([instream])[0]
+
+    def routine_batch(self, instreams):
+        # each sentence has to be one line, or the results of the batch would be misaligned
+        positions = [i for i, instream in enumerate(instreams) if instream[0].strip()]
+        tokens = [instreams[i][0] if instreams[i][0].endswith("\n") else instreams[i][0] + "\n" for i in positions]
+        outputs = iter(self.egret.process_batch(tokens))
+        self.last_fallbacks = {positions[i] for i in self.egret.fallback_indices}
+        return [(next(outputs),) if instream[0].strip() else ("failed\nempty\n",) for instream in instreams]
+
+    def fallbacks(self):
+        return self.last_fallbacks
 
-        egret_tree = egret_tree.lower()
+    def supervision(self):
+        return self.egret.restarts, self.egret.timeouts
 
-        if len(egret_tree.rstrip("\n").split("\n")) <= 2:
-            self.egret.stdout.readline()
-            return ("failed\nparser",)
+    def close(self):
+        self.egret.close()
 
-        return ("success\n" + egret_tree,)
+    def kill(self):
+        self.egret.kill()
@@ -10,3 +10,6 @@ class Command:
 
 	def routine(self, instream):
 		return (instream[0].lower(),)
+
+	def routine_batch(self, instreams):
+		return [(instream[0].lower(),) for instream in instreams]
@@ -14,3 +14,6 @@ class Command:
 	def routine(self, instream):
 		wordconcat = " ".join(instream[0].split())
 		return (wordconcat + "\n",)
+
+	def routine_batch(self, instreams):
+		return [(" ".join(instream[0].split()) + "\n",) for instream in instreams]
@@ -1,6 +1,7 @@
-import subprocess
 import re
 
+from ChamberLang.child import ChildProcess, readline
+
 
 class Command:
 
@@ -9,39 +10,50 @@ class Command:
     MultiThreadable = True
     ShareResources = False
 
-    def __init__(self, bin, config, showerr=False):
-        self.travatar = subprocess.Popen([bin, "-config_file", config, "-trace_out", "STDOUT", "-in_format", "egret", "-buffer", "false"],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None if showerr else subprocess.PIPE, universal_newlines=True)
+    def __init__(self, bin, config, showerr=False, inflight=1, timeout=None, retries=0, fallback=None):
+        self.travatar = ChildProcess([bin, "-config_file", config, "-trace_out", "STDOUT", "-in_format", "egret", "-buffer", "false"],
+            self.read, showerr, inflight, timeout, retries, ("failed\n" + fallback, "") if fallback is not None else None)
+        self.last_fallbacks = set()
 
         self.span_reg = re.compile(r"\[([0-9]+), ([0-9]+)\]")
 
-    def routine(self, instream):
-        egret_tree = instream[0]
-        if not egret_tree.startswith("success\n"):
-            return (egret_tree, "",)
-
-        egret_tree = egret_tree[8:]
-        self.travatar.stdin.write(egret_tree)
-        self.travatar.stdin.flush()
-
-        travatar_trace = self.travatar.stdout.readline()
-        spltrace = travatar_trace.split(" ||| ")
-        m = self.span_reg.match(spltrace[1])
+    def read(self, stdout):
+        travatar_trace = [readline(stdout)]
+        m = self.span_reg.match(travatar_trace[0].split(" ||| ")[1])
 
         inputlen = int(m.group(2))
 
         while True:
-            travatar_trace_line = self.travatar.stdout.readline()
-            spltrace = travatar_trace_line.split(" ||| ")
-            spltree = spltrace[2].split(" ")
-            for x in spltree:
-                if x and x[0] == x[-1] == "\"":
-                    inputlen -= 1
+            spltrace = readline(stdout).split(" ||| ")
+            inputlen -= sum(1 for x in spltrace[2].split(" ") if x and x[0] == x[-1] == "\"")
             spltrace[4] = ".\n"
-            travatar_trace += " ||| ".join(spltrace)
+            travatar_trace.append(" ||| ".join(spltrace))
             if not inputlen:
                 break
-        
-        travatar_output = self.travatar.stdout.readline().rstrip("\n")
 
-        return ("success\n" + travatar_output + "\n" + travatar_trace, travatar_output,)
+        travatar_output = readline(stdout).rstrip("\n")
+
+        return ("success\n" + travatar_output + "\n" + "".join(travatar_trace), travatar_output,)
+
+    def routine(self, instream):
+        return self.routine_batch([instream])[0]
+
+    def routine_batch(self, instreams):
+        # failed parses are passed through without being sent
+        parsed = [instream[0].startswith("success\n") for instream in instreams]
+        positions = [i for i, p in enumerate(parsed) if p]
+        outputs = iter(self.travatar.process_batch([instreams[i][0][8:] for i in positions]))
+        self.last_fallbacks = {positions[i] for i in self.travatar.fallback_indices}
+        return [next(outputs) if p else (instream[0], "",) for instream, p in zip(instreams, parsed)]
+
+    def fallbacks(self):
+        return self.last_fallbacks
+
+    def supervision(self):
+        return self.travatar.restarts, self.travatar.timeouts
+
+    def close(self):
+        self.travatar.close()
+
+    def kill(self):
+        self.travatar.kill()
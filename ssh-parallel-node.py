@@ -1,49 +1,141 @@
 #!/usr/bin/python3
 
+import os
 import sys
+import stat
 import pickle
+import socket
+import ipaddress
+import argparse
+import threading
 import traceback
+import socketserver
 
+from ChamberLang.registry import CommandRegistry
+from ChamberLang.remote import accept_node, load_secret, AuthenticationError, HEARTBEAT_INTERVAL
 
-def main():
 
-	commandname = sys.stdin.buffer.readline().decode("utf-8").rstrip("\n")
-	datasize = sys.stdin.buffer.readline()
-	p_kwargs = sys.stdin.buffer.read(int(datasize))
+def serve(stdin, stdout, registry, secret=None):
+
+	commandname, protocol = accept_node(stdin, stdout, secret)
+	datasize = stdin.readline()
+	p_kwargs = stdin.read(int(datasize))
 	kwargs = pickle.loads(p_kwargs)
 
-	try:
-		if hasattr(__import__("plugins", fromlist=[commandname]), commandname):
-			klass = getattr(__import__("plugins", fromlist=[commandname]), commandname).Command
-		else:
-			klass = getattr(__import__("ChamberLang.commands", fromlist=[commandname]), commandname).Command
-	except AttributeError:
-		raise Exception("Command \"%s\" is not found" % commandname)
+	klass = registry.find(commandname)
 
 	command = klass(**kwargs)
 
+	lock = threading.Lock()
+	stopped = threading.Event()
+	def heartbeat():
+		# the wrapper tells a node working on a long record from a dead one
+		while not stopped.wait(HEARTBEAT_INTERVAL):
+			with lock:
+				protocol.send_heartbeat(stdout)
+	if protocol.heartbeat:
+		threading.Thread(target=heartbeat, daemon=True).start()
+
+	# frames are answered in order, and the wrapper keeps sending while they are processed
 	while True:
-		datasize = sys.stdin.buffer.readline()
-		p_instream = sys.stdin.buffer.read(int(datasize))
-		instream = pickle.loads(p_instream)
-		outdata = {}
 		try:
-			outstream = command.routine(instream)
-			outdata["status"] = "success"
-			outdata["data"] = outstream
-			if outstream is None:
-				break
+			tag, instreams = protocol.receive_request(stdin)
+		except EOFError:
+			break
+		try:
+			if hasattr(command, "routine_batch"):
+				outstreams = list(command.routine_batch(instreams))
+			else:
+				outstreams = []
+				for instream in instreams:
+					outstreams.append(command.routine(instream))
+					if outstreams[-1] is None:
+						break
 		except Exception:
-			tr = traceback.format_exc()
-			outdata["status"] = "failed"
-			outdata["data"] = tr
+			with lock:
+				protocol.send_result(stdout, tag, False, traceback.format_exc())
 			break
-		finally:
-			p_outdata = pickle.dumps(outdata)
-			print(len(p_outdata), file=sys.stdout)
-			sys.stdout.flush()
-			sys.stdout.buffer.write(p_outdata)
-			sys.stdout.flush()
+		with lock:
+			protocol.send_result(stdout, tag, True, outstreams)
+
+	stopped.set()
+	if hasattr(command, "close"):
+		command.close()
+
+
+class NodeHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		try:
+			serve(self.rfile, self.wfile, self.server.registry, self.server.secret)
+		except AuthenticationError as e:
+			print("Rejected %s: %s" % (self.client_address or "a client", e), file=sys.stderr)
+
+
+# each connection is served by a forked process, which starts much faster than a new interpreter
+
+class TCPNodeServer(socketserver.ForkingMixIn, socketserver.TCPServer):
+	allow_reuse_address = True
+
+
+class UnixNodeServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+
+	def server_bind(self):
+		# a socket file left by a server that was killed is replaced
+		if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+			os.unlink(self.server_address)
+		super().server_bind()
+
+	def server_close(self):
+		super().server_close()
+		try:
+			os.unlink(self.server_address)
+		except OSError:
+			pass
+
+
+def is_loopback(host):
+	try:
+		return all(ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in socket.getaddrinfo(host, None))
+	except (OSError, ValueError):
+		return False
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Worker node of SSHParallelWrapper and SocketParallelWrapper")
+	parser.add_argument("-l", "--listen", default=None, help="serve connections on host:port or unix:path instead of standard input")
+	parser.add_argument("-s", "--slots", type=int, default=40, help="maximum number of connections served at once (default: 40)")
+	parser.add_argument("--secret-file", default=None, help="file of the secret shared with the wrappers (default: $CHAMBER_NODE_SECRET)")
+	args = parser.parse_args()
+
+	registry = CommandRegistry()
+
+	if args.listen is None:
+		serve(sys.stdin.buffer, sys.stdout.buffer, registry)
+		return
+
+	try:
+		secret = load_secret(args.secret_file)
+	except Exception as e:
+		parser.error(str(e))
+
+	if args.listen.startswith("unix:"):
+		server = UnixNodeServer(args.listen[5:], NodeHandler)
+	else:
+		host, port = args.listen.rsplit(":", 1)
+		if not is_loopback(host):
+			print("Warning: listening on `%s', which other computers may reach. Keep the secret and the network private." % host, file=sys.stderr)
+		server = TCPNodeServer((host, int(port)), NodeHandler)
+	server.secret = secret
+	server.max_children = args.slots
+	# commands are listed once, and the processes of the connections inherit the list
+	server.registry = registry
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
 
 
 if __name__ == "__main__":